@@ -0,0 +1,373 @@
+"""Benchmark offline regist.py terhadap server Bot API tiruan di localhost.
+
+Menjalankan handler dan job asli dari regist.py: laporan "TEST DAFTAR" dikirim
+sebagai webhook ke handle_webhook untuk N grup × semua brand setiap jam, dan
+timeline shift digerakkan dengan waktu virtual melewati shift pagi, siang dan
+malam. Hasil ditulis sebagai JSON supaya bisa dibandingkan antar commit.
+
+    python bench_regist.py --groups 50 --latency-ms 20 --retry-after-rate 0.01
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import regist
+
+BENCH_THREAD_ID = 1
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+OPERATOR = {"id": 100, "is_bot": False, "first_name": "Operator", "username": "operator"}
+
+# ----------------------
+# Server Bot API Tiruan
+# ----------------------
+class FakeBotAPI:
+    """Server Bot API minimal yang mencatat semua panggilan.
+
+    Bisa menyuntikkan latensi, balasan 429 (RetryAfter) dan error 400 untuk
+    method yang mengirim / mengubah pesan.
+    """
+
+    INJECTABLE = {"sendMessage", "editMessageText", "pinChatMessage", "unpinChatMessage"}
+
+    def __init__(self, latency=0.0, retry_after_rate=0.0, retry_after=1, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = []  # (method, chat_id, waktu)
+        self.injected = {"retry_after": 0, "error": 0}
+        self._message_id = 1000
+
+    def app(self):
+        web_app = web.Application()
+        web_app.add_routes([web.post("/bot{token}/{method}", self.handle)])
+        return web_app
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        chat_id = params.get("chat_id")
+        self.calls.append((method, int(chat_id) if chat_id else None, time.perf_counter()))
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in self.INJECTABLE:
+            roll = self.random.random()
+            if roll < self.retry_after_rate:
+                self.injected["retry_after"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            if roll < self.retry_after_rate + self.error_rate:
+                self.injected["error"] += 1
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: injected"}, status=400)
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            if method == "sendMessage":
+                self._message_id += 1
+            chat_id = int(params["chat_id"])
+            message = {
+                "message_id": int(params.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if params.get("reply_markup"):
+                markup = params["reply_markup"]
+                message["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+            return message
+        if method == "getChatMember":
+            return {"status": "member", "user": OPERATOR}
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "user": OPERATOR, "is_anonymous": False}]
+        return True
+
+    def count(self, since=0.0):
+        by_method = {}
+        for method, _, at in self.calls:
+            if at >= since:
+                by_method[method] = by_method.get(method, 0) + 1
+        return by_method
+
+# ----------------------
+# Lalu Lintas Webhook
+# ----------------------
+class Traffic:
+    def __init__(self, client):
+        self.client = client
+        self.update_id = 0
+        self.message_id = 0
+
+    def _message(self, chat_id, text, **extra):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"grup {chat_id}", "is_forum": True},
+            "from": OPERATOR,
+            "message_thread_id": BENCH_THREAD_ID,
+            "is_topic_message": True,
+        }
+        message.update(extra)
+        if text.startswith("/"):
+            message["text"] = text
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        elif "photo" in extra:
+            message["caption"] = text
+        else:
+            message["text"] = text
+        return {"update_id": self.update_id, "message": message}
+
+    async def post(self, update):
+        headers = {}
+        if regist.WEBHOOK_SECRET:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = regist.WEBHOOK_SECRET
+        resp = await self.client.post(regist.WEBHOOK_PATH, data=json.dumps(update), headers=headers)
+        return resp.status
+
+    async def command(self, chat_id, text):
+        return await self.post(self._message(chat_id, text))
+
+    async def report(self, chat_id, brand, jam):
+        photo = [{"file_id": "bench", "file_unique_id": "bench", "width": 1, "height": 1}]
+        return await self.post(self._message(chat_id, f"TEST DAFTAR\nBRAND: {brand}\nWAKTU: {jam}", photo=photo))
+
+# ----------------------
+# Harness
+# ----------------------
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.clock = None
+        self.sent_at = {}    # (chat_id, bit) -> perf_counter saat laporan dikirim (burst berjalan)
+        self.ticked_at = {}  # (chat_id, bit) -> perf_counter saat bit tercentang (burst berjalan)
+        self.latencies = []  # ms, semua burst
+        self.seen = {}       # chat_id -> mask terakhir yang terlihat
+        self.groups = [-(1000000000000 + i) for i in range(args.groups)]
+
+    def install_hooks(self):
+        regist.now_local = lambda: self.clock
+        if self.args.render_delay is not None:
+            regist.RENDER_DELAY = self.args.render_delay
+        if not self.args.telegram_limits:
+            regist.OUTBOX = regist.Outbox(global_rate=1e6, chat_rate=1e6, chat_burst=1e6)
+
+        render = regist.request_schedule_render
+
+        def spy(bot, chat_id, chat_data, waktu, message_id=None):
+            now = time.perf_counter()
+            mask = chat_data.get("slots", 0)
+            new = mask & ~self.seen.get(chat_id, 0)
+            self.seen[chat_id] = mask
+            while new:
+                bit = new & -new
+                self.ticked_at.setdefault((chat_id, bit), now)
+                new ^= bit
+            render(bot, chat_id, chat_data, waktu, message_id)
+
+        regist.request_schedule_render = spy
+
+    def set_clock(self, logical_date, h, m):
+        day = logical_date + datetime.timedelta(days=1) if h < 7 else logical_date
+        self.clock = datetime.datetime.combine(day, datetime.time(h, m), tzinfo=regist.timezone)
+
+    async def settle(self, app, timeout=60.0):
+        """Tunggu sampai webhook, update_queue, render dan antrian kirim kosong."""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            q = regist.OUTBOX.stats()
+            if (self.web_app["updates"].empty() and app.update_queue.empty()
+                    and not regist._render_tasks and not q["depth"] and not q["in_flight"]
+                    and not any(lane[0].qsize() for lane in app._update_processor._lanes.values())):
+                await asyncio.sleep(0.01)
+                if app.update_queue.empty() and not regist._render_tasks:
+                    return
+            await asyncio.sleep(0.01)
+
+    async def run_event(self, app, at):
+        ctx = type("Ctx", (), {})()
+        ctx.job = type("Job", (), {"data": at})()
+        ctx.application, ctx.bot, ctx.job_queue = app, app.bot, app.job_queue
+        await regist.job_timeline(ctx)
+
+    async def burst(self, app, traffic, shift, jam):
+        brands = regist.SUBMENUS
+        self.sent_at.clear()
+        self.ticked_at.clear()
+        for cid in self.groups:
+            self.seen[cid] = app.chat_data[cid].get("slots", 0)
+        posts = []
+        for cid in self.groups:
+            for brand in brands:
+                self.sent_at[(cid, regist.SLOTS.bit(shift, brand, jam))] = time.perf_counter()
+                posts.append(traffic.report(cid, brand, jam))
+        statuses = await asyncio.gather(*posts)
+        await self.settle(app)
+        self.latencies.extend(
+            (self.ticked_at[k] - self.sent_at[k]) * 1000 for k in self.sent_at if k in self.ticked_at
+        )
+        return len(posts), sum(1 for s in statuses if s != 200)
+
+    async def run(self):
+        args = self.args
+        fake = FakeBotAPI(args.latency_ms / 1000, args.retry_after_rate, args.retry_after, args.error_rate, args.seed)
+        api_server = TestServer(fake.app())
+        await api_server.start_server()
+
+        tmp = tempfile.mkdtemp(prefix="bench_regist_")
+        self.install_hooks()
+        tracemalloc.start()
+
+        regist.HISTORY.path = os.path.join(tmp, "history.bin")
+        persistence = regist.SQLiteStatePersistence(os.path.join(tmp, "state.sqlite3"), update_interval=5)
+        app = regist.build_application(persistence, base_url=f"http://{api_server.host}:{api_server.port}/bot")
+        self.web_app = regist.build_web_app()
+        client = TestClient(TestServer(self.web_app))
+        await client.start_server()
+        traffic = Traffic(client)
+
+        await app.initialize()
+        # Grup sintetis didaftarkan seperti /atur topik: konfigurasi bawaan, topik benchmark.
+        for cid in self.groups:
+            regist.set_group_config(app, cid, {"thread_id": BENCH_THREAD_ID})
+        await regist.on_startup(app)
+        await app.start()
+        self.web_app["ready"].set()
+        ingest = asyncio.create_task(regist.webhook_ingest(app, self.web_app["updates"]))
+        mem_base = tracemalloc.get_traced_memory()[0]
+
+        result = {"config": vars(args), "shifts": {}}
+        reports = rejected = 0
+        report_wall = 0.0
+        report_calls = {}
+        try:
+            # Satu hari logis per shift: minggu ke-0, 1, 2 dari EPOCH_DATE = pagi, malam, siang.
+            for week in range(len(regist.SHIFTS_ORDER)):
+                logical_date = regist.EPOCH_DATE + datetime.timedelta(weeks=week)
+                self.set_clock(logical_date, 6, 50)
+                shift = regist.rotation_shift(self.clock)
+                await self.run_event(app, (6, 50))
+                if week == 0:
+                    for cid in self.groups:
+                        await traffic.command(cid, "/aktifkan")
+                    await self.settle(app)
+                    mem_groups = tracemalloc.get_traced_memory()[0]
+
+                day_start = time.perf_counter()
+                events = 0
+                ordered = sorted(regist.TIMELINE, key=lambda hm: (hm[0] * 60 + hm[1] - 7 * 60) % (24 * 60))
+                for h, m in ordered:
+                    if (h, m) == (6, 50):
+                        continue
+                    self.set_clock(logical_date, h, m)
+                    await self.run_event(app, (h, m))
+                    events += 1
+                    await self.settle(app)
+                    for kind, ev_shift, jam in regist.TIMELINE[(h, m)]:
+                        if kind != "start" or ev_shift != shift:
+                            continue
+                        self.set_clock(logical_date, h, m + 5)
+                        since = time.perf_counter()
+                        n, bad = await self.burst(app, traffic, shift, jam)
+                        report_wall += time.perf_counter() - since
+                        reports += n
+                        rejected += bad
+                        for method, count in fake.count(since).items():
+                            report_calls[method] = report_calls.get(method, 0) + count
+                result["shifts"][shift] = {"events": events, "wall_s": round(time.perf_counter() - day_start, 3)}
+            await app.update_persistence()
+            await persistence.flush()
+        finally:
+            ingest.cancel()
+            await app.stop()
+            await app.shutdown()
+            await client.close()
+            await api_server.close()
+
+        mem_end = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        latencies = sorted(self.latencies)
+        row_bytes = persistence._db.execute(
+            "SELECT AVG(LENGTH(data) + 8) FROM chat_data"
+        ).fetchone()[0] or 0
+
+        def pct(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 3)
+
+        result.update({
+            "reports": reports,
+            "reports_rejected_http": rejected,
+            "ticks": len(latencies),
+            "throughput_reports_per_s": round(reports / report_wall, 1) if report_wall else None,
+            "report_to_tick_ms": {
+                "p50": pct(0.50), "p99": pct(0.99), "max": round(latencies[-1], 3) if latencies else None,
+                "mean": round(statistics.fmean(latencies), 3) if latencies else None,
+            },
+            "api_calls_per_report": round(sum(report_calls.values()) / reports, 3) if reports else None,
+            "api_calls_during_reports": report_calls,
+            "api_calls_total": fake.count(),
+            "injected": fake.injected,
+            "memory_per_group_bytes": {
+                "after_activation": int((mem_groups - mem_base) / len(self.groups)),
+                "after_rotation": int((mem_end - mem_base) / len(self.groups)),
+            },
+            "state_row_bytes_per_group": round(row_bytes, 1),
+            "outbox": regist.OUTBOX.stats(),
+            "webhook": dict(regist.WEBHOOK_STATS),
+        })
+        return result
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark offline regist.py dengan server Bot API tiruan.")
+    p.add_argument("--groups", type=int, default=20, help="jumlah grup sintetis")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="latensi tambahan per panggilan Bot API")
+    p.add_argument("--retry-after-rate", type=float, default=0.0, help="peluang balasan 429 untuk kirim/edit/pin")
+    p.add_argument("--retry-after", type=int, default=1, help="nilai retry_after (detik) pada balasan 429")
+    p.add_argument("--error-rate", type=float, default=0.0, help="peluang balasan 400 untuk kirim/edit/pin")
+    p.add_argument("--render-delay", type=float, help="ganti RENDER_DELAY (default: nilai regist.py)")
+    p.add_argument("--telegram-limits", action="store_true", help="pakai batas kirim Outbox asli (lambat)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--output", help="tulis JSON ke file ini (default: stdout)")
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(Bench(args).run())
+    out = json.dumps(result, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,42 @@
+import time
+# Titik nol laporan startup: diambil sebelum import pihak ketiga yang berat.
+BOOT_STARTED = time.perf_counter()
 import logging
 import datetime
-import pytz
+import functools
 import os
 import asyncio
 import re
-from aiohttp import web
+import bisect
+import hmac
+import json
+import heapq
+import pickle
+import sqlite3
+import struct
+import socket
+import sys
+import signal
+from collections import OrderedDict, namedtuple
+from zoneinfo import ZoneInfo
+from aiohttp import web, ClientError, ClientSession
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters,
     ContextTypes,
     PicklePersistence,
+    BasePersistence,
+    BaseUpdateProcessor,
+    CallbackContext,
+    PersistenceInput,
 )
 
 # ----------------------
@@ -31,7 +53,14 @@ WEBHOOK_URL_BASE = os.environ.get("WEBHOOK_URL_BASE")
 WEBHOOK_PATH = f"/{token}"
 WEBHOOK_URL = f"{WEBHOOK_URL_BASE}{WEBHOOK_PATH}" if WEBHOOK_URL_BASE else None
 PORT = int(os.environ.get("PORT", 8000))
-timezone = pytz.timezone(os.environ.get("TZ", "Asia/Jakarta"))
+STATE_DB = os.environ.get("STATE_DB", "bot_jadwal_data.sqlite3")
+HISTORY_FILE = os.environ.get("HISTORY_FILE", "bot_jadwal_history.bin")
+PICKLE_FILE = "bot_jadwal_data.pickle"
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", 60))
+# Identitas proses di lease dan klaim event. Akhiran acak membedakan proses baru
+# dari yang lama walau hostname:pid sama (mis. pid 1 di container).
+PROCESS_OWNER = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"
+timezone = ZoneInfo(os.environ.get("TZ", "Asia/Jakarta"))
 
 # ----------------------
 # Schedule & Constants
@@ -50,168 +79,846 @@ TIMES = {
     "malam": ["00:00", "01:00", "02:00", "03:00", "04:00", "05:00", "06:00"],
 }
 
-RESET_TIMES =   {"pagi": "07:00", "siang": "15:00", "malam": "23:00"}
-PREP_TIMES =    {"pagi": "07:50", "siang": "15:50", "malam": "23:50"}
-SUMMARY_TIMES = {"pagi": "14:30", "siang": "22:30", "malam": "06:30"}
+# Event pendamping tiap shift, relatif terhadap slot pertama/terakhir shift tsb
+# (bawaan: reset 07:00, persiapan 07:50, ringkasan 14:30 untuk shift pagi).
+RESET_LEAD = 60    # menit sebelum slot pertama
+PREP_LEAD = 10     # menit sebelum slot pertama
+SUMMARY_LAG = 30   # menit setelah slot terakhir
+ROTATE_AT = (6, 50)
 
 SHIFTS_ORDER = ["pagi", "malam", "siang"]
 EPOCH_DATE = datetime.date(2026, 3, 23)
 
+# ----------------------
+# Metrik (Prometheus)
+# ----------------------
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Registry metrik minimal dengan format teks Prometheus.
+
+    Saat METRICS_ENABLED mati, observe/inc langsung kembali dan handler tidak
+    dibungkus sama sekali, jadi tidak ada biaya di hot-path.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}    # (name, labels) -> float
+        self._collectors = []  # fn() -> [(name, type, labels, value)]
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = Histogram()
+        hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self):
+        samples = {}
+        for (name, labels), value in self._counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in self._histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, hist.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        for fn in self._collectors:
+            for name, labels, value in fn():
+                samples.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+
+        out = []
+        for name, lines in samples.items():
+            if name in self._help:
+                kind, text = self._help[name]
+                out.append(f"# HELP {name} {text}")
+                out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("regist_handler_seconds", "histogram", "Latensi handler update.")
+METRICS.describe("regist_api_seconds", "histogram", "Latensi panggilan Bot API per method.")
+METRICS.describe("regist_api_calls_total", "counter", "Jumlah panggilan Bot API per method dan hasil.")
+METRICS.describe("regist_job_lag_seconds", "histogram", "Selisih waktu eksekusi job_* terhadap jadwalnya.")
+METRICS.describe("regist_fanout_group_seconds", "histogram", "Durasi event timeline satu grup di dalam fan-out.")
+METRICS.describe("regist_persistence_flush_seconds", "histogram", "Durasi commit state ke SQLite.")
+METRICS.describe("regist_update_queue_depth", "gauge", "Jumlah update yang menunggu di Application.update_queue.")
+METRICS.describe("regist_outbox_depth", "gauge", "Jumlah pesan di antrian kirim.")
+METRICS.describe("regist_outbox_events_total", "counter", "Pesan antrian kirim per hasil.")
+METRICS.describe("regist_webhook_requests_total", "counter", "POST webhook per hasil penyaringan.")
+METRICS.describe("regist_lane_dropped_total", "counter", "Update yang dibuang karena lajur chat-nya penuh.")
+METRICS.describe("regist_startup_seconds", "gauge", "Durasi tiap tahap startup proses ini.")
+
+def instrumented(handler):
+    """Bungkus handler untuk mencatat latensinya; tanpa METRICS_ENABLED handler dikembalikan apa adanya."""
+    if not METRICS.enabled:
+        return handler
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            METRICS.observe("regist_handler_seconds", time.perf_counter() - start, handler=name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest yang mencatat jumlah, latensi, error dan flood-wait per method Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            METRICS.inc("regist_api_calls_total", method=api_method, result="network_error")
+            raise
+        finally:
+            METRICS.observe("regist_api_seconds", time.perf_counter() - start, method=api_method)
+        if code == 429:
+            result = "flood_wait"
+        elif code >= 400:
+            result = "error"
+        else:
+            result = "ok"
+        METRICS.inc("regist_api_calls_total", method=api_method, result=result)
+        return code, payload
+
+# ----------------------
+# Status Slot (Bitmask)
+# ----------------------
+# Batas jadwal yang bisa disimpan apa adanya: mask di record riwayat selebar
+# MAX_SLOT_BITS dan jumlah brand/slot disimpan sebagai satu byte. Kolom slots di
+# SQLite (BLOB) tidak membatasi; compile_schedule menolak jadwal di luar batas ini.
+MAX_SLOT_BITS = 256  # brand × slot per shift (36 brand × 7 slot)
+MAX_SLOT_COUNT = 255  # brand atau slot per shift
+
+class SlotIndex:
+    """Tabel indeks brand × jam untuk status laporan dalam bentuk bitmask.
+
+    Bit untuk (brand, jam) ada di posisi ``brand_idx * n_slots + slot_idx``,
+    dengan slot_idx = urutan jam di dalam shift. Semua tabel dihitung sekali
+    supaya pengecekan di hot-path cukup operasi bit tanpa membuat string.
+    """
+    __slots__ = ("brands", "times", "n_slots", "brand_pos", "slot_pos",
+                 "_jam_bits", "_shift_bits", "_shift_full")
+
+    def __init__(self, brands, times):
+        self.brands = tuple(brands)
+        self.times = {shift: tuple(jams) for shift, jams in times.items()}
+        self.n_slots = max(len(jams) for jams in self.times.values())
+        self.brand_pos = {b: i for i, b in enumerate(self.brands)}
+        self.slot_pos = {shift: {jam: i for i, jam in enumerate(jams)} for shift, jams in self.times.items()}
+
+        self._jam_bits = {}    # shift -> jam -> ((brand, bit), ...)
+        self._shift_bits = {}  # shift -> ((brand, jam, bit), ...) urut brand lalu jam
+        self._shift_full = {}  # shift -> mask semua slot shift tsb
+        for shift, jams in self.times.items():
+            per_jam = {jam: [] for jam in jams}
+            ordered = []
+            full = 0
+            for b_idx, brand in enumerate(self.brands):
+                for s_idx, jam in enumerate(jams):
+                    bit = 1 << (b_idx * self.n_slots + s_idx)
+                    per_jam[jam].append((brand, bit))
+                    ordered.append((brand, jam, bit))
+                    full |= bit
+            self._jam_bits[shift] = {jam: tuple(v) for jam, v in per_jam.items()}
+            self._shift_bits[shift] = tuple(ordered)
+            self._shift_full[shift] = full
+
+    def bit(self, shift, brand, jam):
+        """Bit untuk (brand, jam) di shift tsb, atau 0 jika tidak dikenal."""
+        b_idx = self.brand_pos.get(brand)
+        s_idx = self.slot_pos[shift].get(jam)
+        if b_idx is None or s_idx is None:
+            return 0
+        return 1 << (b_idx * self.n_slots + s_idx)
+
+    def slots(self, shift):
+        return self._shift_bits[shift]
+
+    def missing_for_jam(self, mask, shift, jam):
+        return [brand for brand, bit in self._jam_bits[shift].get(jam, ()) if not mask & bit]
+
+    def brand_masks(self, mask, shift):
+        """Bit laporan per brand (bit ke-i = jam ke-i shift tsb), urut brand."""
+        width = (1 << len(self.times[shift])) - 1
+        return tuple((mask >> (i * self.n_slots)) & width for i in range(len(self.brands)))
+
+    def missing(self, mask, shift):
+        full = self._shift_full[shift]
+        if mask & full == full:
+            return []
+        return [(brand, jam) for brand, jam, bit in self._shift_bits[shift] if not mask & bit]
+
+    @staticmethod
+    def toggle(mask, bit):
+        return mask ^ bit
+
+    def from_keys(self, keys, shift):
+        """Migrasi dari set string lama ``{"DWT_08:00", ...}`` ke bitmask."""
+        mask = 0
+        for key in keys:
+            brand, _, jam = key.partition("_")
+            mask |= self.bit(shift, brand, jam)
+        return mask
+
+SLOTS = SlotIndex(SUBMENUS, TIMES)
+
+def get_slots(chat_data, shift, slot_index=None):
+    """Ambil bitmask laporan grup, sekaligus migrasi ``skips`` lama (pickle) jika masih ada.
+
+    Bit mask relatif terhadap shift, jadi mask milik shift lain (``slot_shift``,
+    mis. sesudah rotasi 06:50 sebelum reset) dibaca sebagai 0.
+    """
+    owner = chat_data.get("slot_shift")
+    if owner is not None and owner != shift:
+        return 0
+    mask = chat_data.get("slots", 0)
+    if "skips" in chat_data:
+        mask |= (slot_index or SLOTS).from_keys(chat_data.pop("skips"), shift)
+        set_slots(chat_data, shift, mask)
+    return mask
+
+def set_slots(chat_data, shift, mask):
+    chat_data["slots"] = mask
+    chat_data["slot_shift"] = shift
+
 # ----------------------
 # Helper Functions
 # ----------------------
+def is_target(chat_id, thread_id) -> bool:
+    cfg = GROUPS.get(chat_id)
+    return cfg is not None and cfg.thread_id == thread_id
+
 def is_allowed(update: Update) -> bool:
     """Mengecek apakah pesan berasal dari grup dan topik yang diizinkan."""
     if not update.effective_chat or not update.message:
         return False
-    return (update.effective_chat.id == TARGET_CHAT_ID and 
-            update.message.message_thread_id == TARGET_THREAD_ID)
+    return is_target(update.effective_chat.id, update.message.message_thread_id)
+
+def now_local() -> datetime.datetime:
+    """Waktu sekarang di zona bot; satu titik supaya benchmark bisa memakai waktu virtual."""
+    return datetime.datetime.now(timezone)
 
-def get_shift_info(now: datetime.datetime):
+def get_shift_info(now: datetime.datetime, schedule=None):
+    epoch = schedule.epoch if schedule else EPOCH_DATE
+    order = schedule.shifts_order if schedule else SHIFTS_ORDER
     if now.hour < 7:
         logical_now = now - datetime.timedelta(days=1)
     else:
         logical_now = now
         
     logical_date = logical_now.date()
-    days_diff = (logical_date - EPOCH_DATE).days
+    days_diff = (logical_date - epoch).days
     weeks_passed = days_diff // 7
     
-    current_shift = SHIFTS_ORDER[weeks_passed % 3]
+    current_shift = order[weeks_passed % len(order)]
     return current_shift, logical_date
 
-def get_target_datetime(jam_str: str, now: datetime.datetime) -> datetime.datetime:
-    target_hour, target_minute = map(int, jam_str.split(':'))
-    target = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
-    
-    if now.hour == 23 and target_hour < 7:
-        target += datetime.timedelta(days=1)
-    elif now.hour < 7 and target_hour >= 23:
-        target -= datetime.timedelta(days=1)
-        
-    return target
+# ----------------------
+# Antrian Kirim (Outbound)
+# ----------------------
+# Urutan prioritas (kecil = duluan): peringatan batas waktu dan ringkasan
+# shift tidak boleh tertahan di belakang ping "mulai" atau edit keyboard.
+PRIORITY = {"warn": 0, "rekap": 1, "prep": 2, "reply": 3, "pin": 4, "start": 5, "edit": 6}
+
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", 30))      # pesan/detik semua chat
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", 20)) / 60     # pesan/detik per grup
+OUTBOX_CHAT_BURST = float(os.environ.get("OUTBOX_CHAT_BURST", 3))
+OUTBOX_MAX_DEPTH = int(os.environ.get("OUTBOX_MAX_DEPTH", 1000))
+OUTBOX_MAX_RETRY = 5
+
+def _retry_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, datetime.timedelta) else float(ra)
+
+class OutboxDropped(Exception):
+    """Pesan dibuang karena antrian penuh oleh pesan berprioritas lebih tinggi."""
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = 0.0
+
+    def wait_time(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (self.stamp - now) + (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """Kosongkan bucket sampai `seconds` ke depan (dipakai untuk RetryAfter)."""
+        self.tokens = 0
+        self.stamp = max(self.stamp, now + seconds)
+
+class _OutItem:
+    __slots__ = ("priority", "seq", "kind", "chat_id", "fn", "kwargs", "future", "not_before", "retries")
+
+    def __init__(self, priority, seq, kind, chat_id, fn, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.kind = kind
+        self.chat_id = chat_id
+        self.fn = fn
+        self.kwargs = kwargs
+        self.future = future
+        self.not_before = 0.0
+        self.retries = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    """Satu antrian kirim untuk semua panggilan Bot API yang menghasilkan pesan.
+
+    Menjaga batas global dan per-chat dengan token bucket, menunda (bukan
+    membuang) pesan yang kena RetryAfter, dan mendahulukan jenis pesan yang
+    penting. Worker dijalankan otomatis saat pesan pertama masuk.
+
+    Pesan disimpan per chat (heap prioritas masing-masing). Chat yang kepala
+    antriannya siap kirim ada di ``_ready`` (urut prioritas kepala), chat yang
+    tertahan bucket/flood-wait ada di ``_waiting`` (urut waktu siap), jadi satu
+    kiriman cukup O(log jumlah chat) walau backlog chat yang tertahan besar.
+    Entri kedua heap itu divalidasi malas terhadap kepala antrian chat-nya.
+    """
+
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, max_depth=OUTBOX_MAX_DEPTH):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_depth = max_depth
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queues = {}   # chat_id -> heap _OutItem
+        self._ready = []    # (priority, seq, chat_id) kepala antrian yang siap kirim
+        self._waiting = []  # (waktu siap, chat_id)
+        self._depth = 0
+        self._seq = 0
+        self._wakeup = None
+        self._worker = None
+        self._running = set()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = {}
+
+    # --- API ---
+    def post(self, kind, chat_id, fn, /, **kwargs):
+        """Kirim tanpa menunggu hasil; kegagalan cukup dicatat di log."""
+        fut = self._submit(kind, chat_id, fn, kwargs)
+        fut.add_done_callback(self._log_failure)
+        return fut
+
+    async def call(self, kind, chat_id, fn, /, **kwargs):
+        """Kirim lewat antrian dan tunggu hasil Bot API-nya (error diteruskan)."""
+        return await self._submit(kind, chat_id, fn, kwargs)
+
+    async def drain(self, timeout):
+        """Tunggu antrian kosong dan semua kiriman selesai; kembalikan sisa antrian."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._depth or self._running) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        return self._depth
+
+    def stats(self):
+        by_kind = {}
+        for queue in self._queues.values():
+            for item in queue:
+                by_kind[item.kind] = by_kind.get(item.kind, 0) + 1
+        return {"depth": self._depth, "by_kind": by_kind, "in_flight": len(self._running),
+                "sent": self.sent, "failed": self.failed, "retried": self.retried,
+                "dropped": dict(self.dropped)}
+
+    # --- internal ---
+    def _submit(self, kind, chat_id, fn, kwargs):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+        fut = loop.create_future()
+        self._seq += 1
+        item = _OutItem(PRIORITY[kind], self._seq, kind, chat_id, fn, kwargs, fut)
+        if self._depth >= self.max_depth:
+            # Hanya terjadi saat antrian penuh, jadi pindai penuh di sini masih wajar.
+            worst = max(it for queue in self._queues.values() for it in queue)
+            if not item < worst:
+                self._drop(item)
+                return fut
+            queue = self._queues[worst.chat_id]
+            queue.remove(worst)
+            heapq.heapify(queue)
+            self._depth -= 1
+            self._drop(worst)
+        self._enqueue(item, loop.time())
+        return fut
+
+    def _enqueue(self, item, now):
+        queue = self._queues.setdefault(item.chat_id, [])
+        heapq.heappush(queue, item)
+        self._depth += 1
+        if queue[0] is item:
+            # Kepala baru: entri lama chat ini jadi basi. Kalau bukan kepala,
+            # entri yang ada tetap berlaku dan tidak perlu ditambah.
+            self._schedule(item.chat_id, now)
+        self._wakeup.set()
+
+    def _head(self, chat_id):
+        """Kepala antrian chat (item yang future-nya sudah selesai dibuang dulu)."""
+        queue = self._queues.get(chat_id)
+        while queue and queue[0].future.done():
+            heapq.heappop(queue)
+            self._depth -= 1
+        if not queue:
+            self._queues.pop(chat_id, None)
+            return None
+        return queue[0]
+
+    def _schedule(self, chat_id, now):
+        """Masukkan chat ke `_ready` atau `_waiting` sesuai kepala antriannya."""
+        head = self._head(chat_id)
+        if head is None:
+            return
+        wait = max(head.not_before - now, self._bucket(chat_id).wait_time(now))
+        if wait <= 0:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._waiting, (now + wait, chat_id))
+
+    def _drop(self, item):
+        self.dropped[item.kind] = self.dropped.get(item.kind, 0) + 1
+        if not item.future.done():
+            item.future.set_exception(OutboxDropped(f"antrian penuh, {item.kind} ke {item.chat_id} dibuang"))
+
+    @staticmethod
+    def _log_failure(fut):
+        if fut.cancelled() or not fut.exception():
+            return
+        if isinstance(fut.exception(), OutboxDropped):
+            logger.warning(f"{fut.exception()}")
+        else:
+            logger.error(f"Gagal kirim pesan: {fut.exception()}")
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:
+                # Bucket yang sudah penuh kembali tidak menyimpan informasi apa pun.
+                now = asyncio.get_running_loop().time()
+                self._chats = {c: b for c, b in self._chats.items() if b.wait_time(now) or b.tokens < b.capacity}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_ready(self, now):
+        """Ambil item siap kirim berprioritas tertinggi; jika tidak ada, kembalikan lama tunggu."""
+        if not self._depth:
+            return None, None
+        g_wait = self._global.wait_time(now)
+        if g_wait:
+            return None, g_wait
+
+        while self._waiting and self._waiting[0][0] <= now:
+            self._schedule(heapq.heappop(self._waiting)[1], now)
+        while self._ready:
+            _, seq, chat_id = heapq.heappop(self._ready)
+            head = self._head(chat_id)
+            if head is None:
+                continue
+            if head.seq != seq:
+                # Entri basi (kepala berganti, mis. future dibatalkan): jadwalkan ulang
+                # dari kepala sekarang; duplikat entri nanti ikut tersaring di sini.
+                self._schedule(chat_id, now)
+                continue
+            if max(head.not_before - now, self._bucket(chat_id).wait_time(now)) > 0:
+                self._schedule(chat_id, now)
+                continue
+            heapq.heappop(self._queues[chat_id])
+            self._depth -= 1
+            self._global.consume()
+            self._bucket(chat_id).consume()
+            self._schedule(chat_id, now)
+            return head, None
+        return None, (self._waiting[0][0] - now if self._waiting else None)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, wait = self._next_ready(loop.time())
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = loop.create_task(self._execute(item))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, item):
+        try:
+            result = await item.fn(**item.kwargs)
+        except RetryAfter as e:
+            seconds = _retry_seconds(e)
+            item.retries += 1
+            self.retried += 1
+            if item.retries > OUTBOX_MAX_RETRY:
+                self.failed += 1
+                if not item.future.done():
+                    item.future.set_exception(e)
+                return
+            now = asyncio.get_running_loop().time()
+            logger.warning(f"Flood-wait {item.kind} grup {item.chat_id}: tunda {seconds}s")
+            item.not_before = now + seconds
+            self._bucket(item.chat_id).pause(now, seconds)
+            self._enqueue(item, now)
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+
+OUTBOX = Outbox()
+
+async def reply(message, text, **kwargs):
+    """reply_text lewat OUTBOX, supaya balasan handler ikut batas kirim per chat."""
+    return await OUTBOX.call("reply", message.chat_id, message.reply_text, text=text, **kwargs)
+
+# ----------------------
+# Parser Laporan
+# ----------------------
+REPORT_MARK = re.compile(r"TEST DAFTAR", re.IGNORECASE)
+# Satu pasangan BRAND ... WAKTU atau WAKTU ... BRAND (format lama menerima urutan
+# bebas); bagian tengah tidak boleh melewati label pembuka yang sama, sehingga
+# beberapa laporan dalam satu caption terbaca berpasangan.
+REPORT_PAIR = re.compile(
+    r"BRAND\s*:\s*([A-Z0-9]+)(?:(?!BRAND).)*?WAKTU\s*:\s*(\d{2}:\d{2})"
+    r"|WAKTU\s*:\s*(\d{2}:\d{2})(?:(?!WAKTU).)*?BRAND\s*:\s*([A-Z0-9]+)",
+    re.IGNORECASE | re.DOTALL,
+)
+WINDOW_BEFORE = datetime.timedelta(minutes=10)
+WINDOW_AFTER = datetime.timedelta(minutes=30)
+
+def parse_reports(text):
+    """Semua pasangan (BRAND, WAKTU) dalam satu pesan, urut kemunculan."""
+    return [((brand or brand2).upper(), jam or jam2) for brand, jam, jam2, brand2 in REPORT_PAIR.findall(text)]
+
+@functools.lru_cache(maxsize=None)
+def parse_jam(jam):
+    """Ubah "HH:MM" menjadi (jam, menit); tiap string jam cukup di-parse sekali."""
+    h, m = jam.split(':')
+    return int(h), int(m)
+
+def _window_regime(now):
+    # Jam 23 melihat ke hari berikutnya (slot 00:00-06:00), sebelum 07 melihat ke hari sebelumnya.
+    if now.hour == 23:
+        return 1
+    if now.hour < 7:
+        return -1
+    return 0
+
+@functools.lru_cache(maxsize=256)
+def acceptance_windows(jams, day, regime):
+    """Tabel jam -> (awal, akhir) jendela laporan untuk deret jam satu shift, dibangun sekali per hari."""
+    windows = {}
+    for jam in jams:
+        h, m = parse_jam(jam)
+        target_day = day
+        if regime == 1 and h < 7:
+            target_day += datetime.timedelta(days=1)
+        elif regime == -1 and h >= 23:
+            target_day -= datetime.timedelta(days=1)
+        target = datetime.datetime.combine(target_day, datetime.time(h, m), tzinfo=timezone)
+        windows[jam] = (target - WINDOW_BEFORE, target + WINDOW_AFTER)
+    return windows
 
 # ----------------------
 # Tampilan Jadwal
 # ----------------------
-async def send_schedule_to_chat(bot, chat_id, chat_data, waktu, message_id=None, pin_message=False):
-    thread_id = chat_data.get("thread_id") or TARGET_THREAD_ID
-    text = f"📋 *Jadwal Shift {waktu.capitalize()}*\n_Otomatis tercentang saat bukti dikirim._"
+# Jeda penggabungan render: semua perubahan centang dalam jendela ini
+# digabung menjadi satu edit_message_text per chat.
+RENDER_DELAY = float(os.environ.get("RENDER_DELAY", 2.0))
+
+_render_pending = {}  # chat_id -> dict(bot, chat_data, waktu, message_id)
+_render_tasks = {}    # chat_id -> asyncio.Task yang sedang menunggu jendela
+_render_sent = {}     # chat_id -> (message_id, signature) terakhir yang terkirim
+
+@functools.lru_cache(maxsize=4096)
+def _brand_rows(brand, jams, bits):
+    """Baris keyboard satu brand. Di-cache per status bit brand tsb, jadi hanya
+    brand yang baru dicentang yang dibuat ulang saat render."""
+    def sym(i):
+        return "✅" if bits >> i & 1 else "❌"
+    rows = [(InlineKeyboardButton(f"{brand} {jams[0]} {sym(0)}", callback_data=f"toggle_{brand}_{jams[0]}"),)]
+    rest = [InlineKeyboardButton(f"{jam} {sym(i)}", callback_data=f"toggle_{brand}_{jam}") for i, jam in enumerate(jams[1:], 1)]
+    rows += [tuple(rest[i:i + 3]) for i in range(0, len(rest), 3)]
+    return tuple(rows)
+
+def _page_nav(page, pages):
+    return [InlineKeyboardButton("⬅️", callback_data=f"page_{(page - 1) % pages}"),
+            InlineKeyboardButton(f"📄 {page + 1}/{pages}", callback_data=f"page_{page}"),
+            InlineKeyboardButton("➡️", callback_data=f"page_{(page + 1) % pages}")]
+
+def build_schedule(chat_data, waktu, slot_index=None):
+    """Teks ringkasan semua brand + keyboard satu halaman (PAGE_SIZE brand).
+
+    Ukuran keyboard tetap per halaman berapa pun jumlah brand-nya; halaman yang
+    tampil disimpan di chat_data["schedule_page"].
+    """
+    slot_index = slot_index or SLOTS
+    mask = get_slots(chat_data, waktu, slot_index)
+    jams = slot_index.times[waktu]
+    brands = slot_index.brands
+    per_brand = slot_index.brand_masks(mask, waktu)
+    pages = -(-len(brands) // PAGE_SIZE)
+    page = min(chat_data.get("schedule_page", 0), pages - 1)
+
+    summary = " · ".join(
+        f"{brand} ✅" if bits.bit_count() == len(jams) else f"{brand} {bits.bit_count()}/{len(jams)}"
+        for brand, bits in zip(brands, per_brand)
+    )
+    title = f"📋 *Jadwal Shift {waktu.capitalize()}*" + (f" (hal {page + 1}/{pages})" if pages > 1 else "")
+    text = f"{title}\n_Otomatis tercentang saat bukti dikirim._\n{summary}"
+
     rows = []
-    skips = chat_data.get("skips", set())
+    lo = page * PAGE_SIZE
+    for brand, bits in zip(brands[lo:lo + PAGE_SIZE], per_brand[lo:lo + PAGE_SIZE]):
+        rows.extend(_brand_rows(brand, jams, bits))
+    if pages > 1:
+        rows.append(_page_nav(page, pages))
+    return text, InlineKeyboardMarkup(rows)
 
-    for sec in SUBMENUS:
-        first = TIMES[waktu][0]
-        sym = "✅" if f"{sec}_{first}" in skips else "❌"
-        rows.append([InlineKeyboardButton(f"{sec} {first} {sym}", callback_data=f"toggle_{sec}_{first}")])
-        
-        small = []
-        for jam in TIMES[waktu][1:]:
-            s2 = "✅" if f"{sec}_{jam}" in skips else "❌"
-            small.append(InlineKeyboardButton(f"{jam} {s2}", callback_data=f"toggle_{sec}_{jam}"))
-        
-        for i in range(0, len(small), 3):
-            rows.append(small[i:i+3])
+def _is_transient(e):
+    """Error yang layak diulang: jaringan/timeout, flood-wait habis, atau dibuang antrian kirim."""
+    return isinstance(e, (NetworkError, RetryAfter, OutboxDropped)) and not isinstance(e, BadRequest)
+
+async def send_schedule_to_chat(bot, chat_id, chat_data, waktu, message_id=None, pin_message=False, kind="reply"):
+    """Kirim atau edit pesan jadwal. Mengembalikan False hanya bila gagal karena error
+    sementara (lihat _is_transient), sehingga pemanggil bisa mengulang."""
+    cfg = group_config(chat_id)
+    thread_id = cfg.thread_id
+    text, markup = build_schedule(chat_data, waktu, cfg.schedule.slots)
+    signature = text + markup.to_json()
 
     if message_id:
+        # Keyboard identik dengan yang terakhir dikirim: tidak perlu panggil API.
+        if _render_sent.get(chat_id) == (message_id, signature):
+            return True
         try:
-            await bot.edit_message_text(
+            await OUTBOX.call(
+                "edit", chat_id, bot.edit_message_text,
                 chat_id=chat_id, message_id=message_id, 
-                text=text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(rows)
+                text=text, parse_mode="Markdown", reply_markup=markup
             )
-            return
-        except Exception as e:
-            if "not modified" not in str(e).lower():
-                pass
+            _render_sent[chat_id] = (message_id, signature)
+            return True
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                _render_sent[chat_id] = (message_id, signature)
+                return True
+            # Pesan hilang / tidak bisa diedit: baru kirim pesan baru.
+            logger.warning(f"Edit jadwal gagal ({e}), kirim pesan baru.")
+        except (TelegramError, OutboxDropped) as e:
+            logger.error(f"Gagal edit pesan jadwal: {e}")
+            return not _is_transient(e)
 
     try:
-        msg = await bot.send_message(
-            chat_id=chat_id, message_thread_id=thread_id, text=text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(rows)
+        msg = await OUTBOX.call(
+            kind, chat_id, bot.send_message,
+            chat_id=chat_id, message_thread_id=thread_id, text=text, parse_mode="Markdown", reply_markup=markup
         )
         chat_data["schedule_msg_id"] = msg.message_id
+        _render_sent[chat_id] = (msg.message_id, signature)
         
         # --- LOGIKA UNPIN LAMA & PIN BARU ---
         if pin_message:
+            # Unpin lama dan pin baru tidak ditunggu: keduanya jalan di antrian
+            # kirim, sementara fan-out sudah lanjut ke pengiriman grup berikutnya.
             last_pinned = chat_data.get("last_pinned_id")
             if last_pinned:
-                try:
-                    await bot.unpin_chat_message(chat_id=chat_id, message_id=last_pinned)
-                except Exception as e:
-                    logger.error(f"Gagal unpin pesan lama: {e}")
+                OUTBOX.post("pin", chat_id, bot.unpin_chat_message, chat_id=chat_id, message_id=last_pinned)
+            pin = OUTBOX.post("pin", chat_id, bot.pin_chat_message, chat_id=chat_id, message_id=msg.message_id, disable_notification=True)
 
-            try:
-                await bot.pin_chat_message(chat_id=chat_id, message_id=msg.message_id, disable_notification=True)
-                chat_data["last_pinned_id"] = msg.message_id
-            except Exception as e:
-                logger.error(f"Gagal pin pesan baru: {e}")
+            def pinned(fut, message_id=msg.message_id):
+                # Dicatat hanya jika Telegram menerima pin-nya, supaya unpin berikutnya
+                # tidak menyasar pesan yang tidak pernah tersemat.
+                if not fut.cancelled() and fut.exception() is None:
+                    chat_data["last_pinned_id"] = message_id
+            pin.add_done_callback(pinned)
+        return True
                 
     except Exception as e:
         logger.error(f"Gagal kirim pesan jadwal: {e}")
+        return not _is_transient(e)
+
+def request_schedule_render(bot, chat_id, chat_data, waktu, message_id=None):
+    """Jadwalkan re-render jadwal; permintaan dalam RENDER_DELAY digabung jadi satu edit."""
+    message_id = message_id or chat_data.get("schedule_msg_id")
+    _render_pending[chat_id] = {"bot": bot, "chat_data": chat_data, "waktu": waktu, "message_id": message_id}
+    # Penanda ikut tersimpan di chat_data, supaya edit yang belum sempat
+    # terkirim dilanjutkan setelah restart (lihat resume_schedule_render).
+    chat_data["render_pending"] = (waktu, message_id)
+    if chat_id not in _render_tasks:
+        _render_tasks[chat_id] = asyncio.create_task(_flush_schedule_render(chat_id))
+
+async def _flush_schedule_render(chat_id):
+    try:
+        await asyncio.sleep(RENDER_DELAY)
+    finally:
+        # Lepas slot task sebelum render, supaya perubahan yang datang selama
+        # edit berjalan memicu jendela baru dan tidak hilang.
+        _render_tasks.pop(chat_id, None)
+    await _render_now(chat_id)
+
+async def _render_now(chat_id, retry=True):
+    p = _render_pending.pop(chat_id, None)
+    if not p:
+        return
+    ok = await send_schedule_to_chat(p["bot"], chat_id, p["chat_data"], p["waktu"], message_id=p["message_id"], kind="edit")
+    if chat_id in _render_pending:
+        # Sudah ada permintaan lebih baru; penandanya milik permintaan itu.
+        return
+    if ok:
+        p["chat_data"].pop("render_pending", None)
+    elif retry:
+        # Gagal sementara: ulang di jendela berikutnya, penanda tetap tersimpan.
+        request_schedule_render(p["bot"], chat_id, p["chat_data"], p["waktu"], p["message_id"])
+
+async def flush_schedule_renders(timeout):
+    """Kirim semua render yang masih menunggu jendela penggabungan sekarang juga (dipakai saat shutdown)."""
+    for task in list(_render_tasks.values()):
+        task.cancel()
+    if _render_pending:
+        try:
+            # Tanpa retry: yang gagal tetap punya penanda dan dilanjutkan setelah start.
+            await asyncio.wait_for(asyncio.gather(*(_render_now(cid, retry=False) for cid in list(_render_pending))), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Sebagian render jadwal belum terkirim saat shutdown; dilanjutkan setelah start.")
+
+def resume_schedule_render(bot, chat_id, chat_data):
+    """Lanjutkan edit jadwal yang tertunda sebelum restart."""
+    pending = chat_data.get("render_pending")
+    if pending:
+        waktu, message_id = pending
+        request_schedule_render(bot, chat_id, chat_data, waktu, message_id)
 
 # ----------------------
 # Sistem Otomatis (JobQueue)
 # ----------------------
-async def job_reset(context: ContextTypes.DEFAULT_TYPE):
-    cid = context.job.data["chat_id"]
-    shift = context.job.data["shift"]
-    chat_data = context.application.chat_data.get(cid)
-    if chat_data is not None:
-        chat_data["skips"] = set()
-        chat_data["history"] = []
-        chat_data.pop("schedule_msg_id", None) 
+# Setiap job_* menerima `d` berisi chat_id, thread_id, shift, jam, config
+# (GroupConfig) dan chat_data grup tujuan; pemanggilnya adalah job_timeline di bawah.
+async def job_reset(context: ContextTypes.DEFAULT_TYPE, d):
+    cid, shift = d["chat_id"], d["shift"]
+    chat_data = d["chat_data"]
+    archive_shift(cid, chat_data)
+    chat_data.pop("skips", None)
+    chat_data["slots"] = 0
+    chat_data.pop("schedule_page", None)
+    # Hari logis dari waktu terjadwal, bukan jam sekarang: reset yang diputar ulang
+    # setelah restart tetap milik hari shift-nya.
+    chat_data["slot_day"] = get_shift_info(d["scheduled"], d["config"].schedule)[1].toordinal()
+    chat_data["slot_shift"] = shift
+    chat_data["history"] = []
+    chat_data.pop("schedule_msg_id", None)
     logger.info(f"🔄 Auto-Reset shift {shift} grup {cid}.")
 
-async def job_persiapan(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data
-    try:
-        chat_data = context.application.chat_data.get(d["chat_id"]) or {}
-        await context.bot.send_message(
-            chat_id=d["chat_id"], message_thread_id=d["thread_id"],
-            text=f"🌅 *PERSIAPAN SHIFT {d['shift'].upper()}*\n\nSilakan mulai mengirimkan laporan.", 
-            parse_mode="Markdown"
-        )
-        await send_schedule_to_chat(context.bot, d["chat_id"], chat_data, d["shift"], pin_message=True)
-    except Exception as e:
-        logger.error(f"Error persiapan: {e}")
+async def job_persiapan(context: ContextTypes.DEFAULT_TYPE, d):
+    # Error diteruskan ke fire_group_events supaya tercatat sebagai grup gagal di fan-out.
+    await OUTBOX.call(
+        "prep", d["chat_id"], context.bot.send_message,
+        chat_id=d["chat_id"], message_thread_id=d["thread_id"],
+        text=f"🌅 *PERSIAPAN SHIFT {d['shift'].upper()}*\n\nSilakan mulai mengirimkan laporan.", 
+        parse_mode="Markdown"
+    )
+    await send_schedule_to_chat(context.bot, d["chat_id"], d["chat_data"], d["shift"], pin_message=True, kind="prep")
 
-async def job_mulai(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data
-    try:
-        await context.bot.send_message(
-            chat_id=d["chat_id"], message_thread_id=d["thread_id"], 
-            text=f"🔔 Waktu pelaporan jadwal *{d['jam']}* dimulai!", parse_mode="Markdown"
-        )
-    except Exception:
-        pass
+# Handler event menunggu kiriman selesai (OUTBOX.call), supaya klaim event baru
+# ditandai selesai setelah Bot API menerima pesannya.
+async def job_mulai(context: ContextTypes.DEFAULT_TYPE, d):
+    await OUTBOX.call(
+        "start", d["chat_id"], context.bot.send_message,
+        chat_id=d["chat_id"], message_thread_id=d["thread_id"], 
+        text=f"🔔 Waktu pelaporan jadwal *{d['jam']}* dimulai!", parse_mode="Markdown"
+    )
 
-async def job_peringatan(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data
-    chat_data = context.application.chat_data.get(d["chat_id"], {})
-    skips = chat_data.get("skips", set())
-    missing = [s for s in SUBMENUS if f"{s}_{d['jam']}" not in skips]
+async def job_peringatan(context: ContextTypes.DEFAULT_TYPE, d):
+    slots = d["config"].schedule.slots
+    missing = slots.missing_for_jam(get_slots(d["chat_data"], d["shift"], slots), d["shift"], d["jam"])
     
     if missing:
-        try:
-            await context.bot.send_message(
-                chat_id=d["chat_id"], message_thread_id=d["thread_id"],
-                text=f"⚠️ *PERINGATAN!* 10 Menit menuju batas akhir laporan *{d['jam']}*.\nBelum lapor: {', '.join(missing)}", 
-                parse_mode="Markdown"
-            )
-        except Exception:
-            pass
+        await OUTBOX.call(
+            "warn", d["chat_id"], context.bot.send_message,
+            chat_id=d["chat_id"], message_thread_id=d["thread_id"],
+            text=f"⚠️ *PERINGATAN!* 10 Menit menuju batas akhir laporan *{d['jam']}*.\nBelum lapor: {', '.join(missing)}", 
+            parse_mode="Markdown"
+        )
 
-async def job_rekap(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data
-    chat_data = context.application.chat_data.get(d["chat_id"], {})
-    skips = chat_data.get("skips", set())
-    terlewat = []
-    
-    for sec in SUBMENUS:
-        for j in TIMES[d['shift']]:
-            if f"{sec}_{j}" not in skips: 
-                terlewat.append(f"❌ {sec} - {j}")
+async def job_rekap(context: ContextTypes.DEFAULT_TYPE, d):
+    slots = d["config"].schedule.slots
+    terlewat = [f"❌ {sec} - {j}" for sec, j in slots.missing(get_slots(d["chat_data"], d["shift"], slots), d["shift"])]
                 
-    admin_tags = "@CalvinWi @daelo"
+    admin_tags = d["config"].admin_tags
     if terlewat:
         msg = (f"📊 <b>RINGKASAN AKHIR SHIFT {d['shift'].upper()}</b>\n\n"
                f"Terdapat jadwal laporan yang <b>TERLEWAT</b>:\n"
@@ -222,47 +929,519 @@ async def job_rekap(context: ContextTypes.DEFAULT_TYPE):
                f"Laporan hari ini <b>SEMPURNA!</b> 🎉 Seluruh jadwal telah dilaporkan.\n\n"
                f"Halo {admin_tags}, operasional berjalan lancar tanpa kendala. 🙏")
                
-    try:
-        await context.bot.send_message(chat_id=d["chat_id"], message_thread_id=d["thread_id"], text=msg, parse_mode="HTML")
-    except Exception:
-        pass
+    await OUTBOX.call("rekap", d["chat_id"], context.bot.send_message, chat_id=d["chat_id"], message_thread_id=d["thread_id"], text=msg, parse_mode="HTML")
+
+# ----------------------
+# Timeline Shift
+# ----------------------
+def _add_minutes(jam, minutes):
+    h, m = parse_jam(jam)
+    total = (h * 60 + m + minutes) % (24 * 60)
+    return total // 60, total % 60
+
+def build_timeline(times=TIMES):
+    """Tabel event harian terurut: {(jam, menit): ((kind, shift, jam_slot), ...)}.
+
+    Dihitung sekali per deret jam; reset, persiapan dan ringkasan diturunkan
+    dari slot pertama/terakhir tiap shift (RESET_LEAD, PREP_LEAD, SUMMARY_LAG).
+    """
+    events = []
+    for shift, jams in times.items():
+        events.append((_add_minutes(jams[0], -RESET_LEAD), "reset", shift, None))
+        events.append((_add_minutes(jams[0], -PREP_LEAD), "prep", shift, None))
+        events.append((_add_minutes(jams[-1], SUMMARY_LAG), "rekap", shift, None))
+        for jam in jams:
+            events.append((_add_minutes(jam, 0), "start", shift, jam))
+            events.append((_add_minutes(jam, 20), "warn", shift, jam))
+    events.append((ROTATE_AT, "rotate", None, None))
+    events.sort(key=lambda e: e[0])
+
+    timeline = {}
+    for at, kind, shift, jam in events:
+        timeline.setdefault(at, []).append((kind, shift, jam))
+    return {at: tuple(evs) for at, evs in timeline.items()}
 
-async def job_rotator(context: ContextTypes.DEFAULT_TYPE):
-    d = context.job.data
-    schedule_group_jobs(context.job_queue, d["chat_id"], d["thread_id"])
+TIMELINE = build_timeline()
 
-def schedule_group_jobs(job_queue, chat_id, thread_id):
-    for job in job_queue.jobs():
-        if job.name and job.name.endswith(f"_{chat_id}") and not job.name.startswith("rotator_"):
-            job.schedule_removal()
+FANOUT_LIMIT = int(os.environ.get("FANOUT_LIMIT", 32))  # grup yang diproses bersamaan per titik waktu
 
-    now = datetime.datetime.now(timezone)
+_group_events = {}  # chat_id -> (shift aktif, ((jam, menit), ...) yang diisi grup ini)
+_at_groups = {}     # (jam, menit) -> {chat_id: ((kind, shift, jam_slot), ...)}
+
+def rotation_shift(now: datetime.datetime, schedule=None):
+    """Shift yang berlaku untuk penjadwalan; menjelang 07:00 sudah memakai shift hari berikutnya."""
     check_time = now + datetime.timedelta(hours=1) if (now.hour == 6 and now.minute >= 45) else now
-    current_shift, _ = get_shift_info(check_time)
-    
-    rh, rm = map(int, RESET_TIMES[current_shift].split(':'))
-    job_queue.run_daily(job_reset, time=datetime.time(hour=rh, minute=rm, tzinfo=timezone), name=f"reset_{current_shift}_{chat_id}", data={"chat_id": chat_id, "shift": current_shift})
+    return get_shift_info(check_time, schedule)[0]
 
-    ph, pm = map(int, PREP_TIMES[current_shift].split(':'))
-    job_queue.run_daily(job_persiapan, time=datetime.time(hour=ph, minute=pm, tzinfo=timezone), name=f"prep_{current_shift}_{chat_id}", data={"chat_id": chat_id, "thread_id": thread_id, "shift": current_shift})
+def register_group(chat_id, shift=None):
+    schedule = group_config(chat_id).schedule
+    shift = shift or rotation_shift(now_local(), schedule)
+    unregister_group(chat_id)
+    points = schedule.shift_points[shift]
+    for at, own in points.items():
+        _at_groups.setdefault(at, {})[chat_id] = own
+    _group_events[chat_id] = (shift, tuple(points))
 
-    sh, sm = map(int, SUMMARY_TIMES[current_shift].split(':'))
-    job_queue.run_daily(job_rekap, time=datetime.time(hour=sh, minute=sm, tzinfo=timezone), name=f"rekap_{current_shift}_{chat_id}", data={"chat_id": chat_id, "thread_id": thread_id, "shift": current_shift})
+def unregister_group(chat_id):
+    old = _group_events.pop(chat_id, None)
+    if old:
+        for at in old[1]:
+            groups = _at_groups.get(at)
+            if groups is not None:
+                groups.pop(chat_id, None)
+                if not groups:
+                    del _at_groups[at]
 
-    for jam in TIMES[current_shift]:
-        h, m = map(int, jam.split(':'))
-        job_queue.run_daily(job_mulai, time=datetime.time(hour=h, minute=m, tzinfo=timezone), name=f"start_{jam}_{chat_id}", data={"chat_id": chat_id, "thread_id": thread_id, "jam": jam})
-        
-        warn_m = m + 20
-        warn_h = h
-        if warn_m >= 60:
-            warn_h = (warn_h + 1) % 24
-            warn_m -= 60
-        job_queue.run_daily(job_peringatan, time=datetime.time(hour=warn_h, minute=warn_m, tzinfo=timezone), name=f"warn_{jam}_{chat_id}", data={"chat_id": chat_id, "thread_id": thread_id, "jam": jam, "shift": current_shift})
+def rotate_groups():
+    """Rotasi mingguan cukup memindahkan grup di indeks, tanpa membongkar job."""
+    now = now_local()
+    for chat_id, (old, _) in list(_group_events.items()):
+        shift = rotation_shift(now, group_config(chat_id).schedule)
+        if old != shift:
+            register_group(chat_id, shift)
+
+def install_timeline(job_queue, schedule=None):
+    """Pasang satu run_daily per titik waktu di timeline jadwal tsb (idempoten).
+
+    Job dibagi semua grup: titik waktu yang sama hanya punya satu timer.
+    """
+    timeline = schedule.timeline if schedule else TIMELINE
+    # Satu kali pindai job yang ada; get_jobs_by_name per titik memindai ulang semuanya.
+    installed = {job.name for job in job_queue.jobs()}
+    for (h, m) in timeline:
+        name = f"timeline_{h:02d}:{m:02d}"
+        if name not in installed:
+            job_queue.run_daily(job_timeline, time=datetime.time(hour=h, minute=m, tzinfo=timezone), name=name, data=(h, m))
+
+async def job_timeline(context: ContextTypes.DEFAULT_TYPE):
+    h, m = context.job.data
+    now = now_local()
+    scheduled = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    if scheduled > now:
+        scheduled -= datetime.timedelta(days=1)
+    if LEASE is not None and not LEASE.holds():
+        # Mode cluster: lease shard sedang lepas (mis. perpanjangan terlambat).
+        # Titik ini diputar ulang oleh job_recover begitu lease kembali dipegang.
+        _deferred_points.append((context.job.data, scheduled))
+        return
+    await run_timeline_point(context, context.job.data, scheduled)
 
-    rotator_name = f"rotator_{chat_id}"
-    if not any(j.name == rotator_name for j in job_queue.jobs()):
-        job_queue.run_daily(job_rotator, time=datetime.time(hour=6, minute=50, tzinfo=timezone), name=rotator_name, data={"chat_id": chat_id, "thread_id": thread_id})
+async def run_timeline_point(context, at, scheduled, late=None):
+    """Jalankan satu titik timeline untuk semua grup terdaftar.
+
+    Jika `late` (detik) diberikan, event yang sudah lewat MISFIRE_GRACE dilewati."""
+    if at == ROTATE_AT:
+        rotate_groups()
+        persistence = context.application.persistence
+        if isinstance(persistence, SQLiteStatePersistence):
+            persistence.prune_events(get_shift_info(scheduled)[1].toordinal() - 7)
+    groups = list(_at_groups.get(at, {}).items())
+    if late is not None:
+        groups = [(cid, due) for cid, events in groups if (due := due_events(events, late))]
+    if groups:
+        await fan_out(context, at, groups, scheduled)
+
+async def fan_out(context, at, groups, scheduled):
+    """Jalankan event satu titik waktu untuk banyak grup bersamaan (maks FANOUT_LIMIT).
+
+    Mengembalikan {chat_id: [kind yang gagal]} dan mencatat ringkasannya, supaya
+    grup yang lambat/gagal terlihat tanpa menahan grup lain.
+    """
+    sem = asyncio.Semaphore(FANOUT_LIMIT)
+    start = time.perf_counter()
+
+    async def one(cid, events):
+        async with sem:
+            t0 = time.perf_counter()
+            failed = await fire_group_events(context, cid, events, scheduled)
+            METRICS.observe("regist_fanout_group_seconds", time.perf_counter() - t0)
+            return cid, failed
+
+    results = dict(await asyncio.gather(*(one(cid, events) for cid, events in groups)))
+    failed = {cid: kinds for cid, kinds in results.items() if kinds}
+    logger.info(f"📣 Timeline {at[0]:02d}:{at[1]:02d}: {len(results)} grup selesai dalam "
+                f"{time.perf_counter() - start:.2f}s" + (f", gagal: {failed}" if failed else "."))
+    return results
+
+async def fire_group_events(context, cid, events, scheduled):
+    """Jalankan event timeline satu grup pada satu titik waktu, lalu majukan cursor event grup tsb.
+
+    Mengembalikan daftar kind event yang gagal."""
+    cfg = group_config(cid)
+    chat_data = await load_chat_data(context.application, cid)
+    # Setiap event per grup per hari logis diklaim dulu di store bersama, jadi
+    # tidak terkirim dua kali walau shard berpindah worker atau bot restart.
+    # Klaim baru ditandai done setelah handler selesai; yang gagal atau
+    # tertinggal proses mati diulang oleh job_recover.
+    persistence = context.application.persistence
+    claims = isinstance(persistence, SQLiteStatePersistence)
+    day = get_shift_info(scheduled)[1].toordinal()
+    scheduled_ts = scheduled.timestamp()
+    failed = []
+    for kind, shift, jam in events:
+        event = f"{kind}:{shift}:{jam or ''}"
+        if claims and not persistence.claim_event(cid, day, event, scheduled_ts):
+            continue
+        handler = TIMELINE_HANDLERS[kind]
+        d = {"chat_id": cid, "thread_id": cfg.thread_id, "shift": shift, "jam": jam,
+             "config": cfg, "chat_data": chat_data, "scheduled": scheduled}
+        METRICS.observe("regist_job_lag_seconds", now_local().timestamp() - scheduled_ts, job=handler.__name__)
+        try:
+            await handler(context, d)
+        except Exception as e:
+            failed.append(kind)
+            logger.error(f"Error event {kind} grup {cid}: {e}")
+            if claims:
+                persistence.finish_event(cid, day, event, "failed")
+        else:
+            if claims:
+                persistence.finish_event(cid, day, event, "done")
+    chat_data["event_cursor"] = max(chat_data.get("event_cursor", 0), scheduled_ts)
+    return failed
+
+TIMELINE_HANDLERS = {
+    "reset": job_reset,
+    "prep": job_persiapan,
+    "rekap": job_rekap,
+    "start": job_mulai,
+    "warn": job_peringatan,
+}
+
+# ----------------------
+# Konfigurasi Grup
+# ----------------------
+# Nilai bawaan untuk grup yang belum punya konfigurasi sendiri. Konfigurasi per
+# grup disimpan di bot_data["group_configs"][chat_id] sebagai dict biasa
+# (thread_id, brands, times, epoch, shifts_order, admin_tags); kunci yang tidak
+# ada memakai bawaan di bawah.
+DEFAULT_ADMIN_TAGS = "@CalvinWi @daelo"
+SHIFT_NAMES = tuple(TIMES)
+BRAND_RE = re.compile(r"[A-Z0-9]+")
+JAM_RE = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+ADMIN_TAG_RE = re.compile(r"@[A-Za-z0-9_]{5,32}")  # dikirim job_rekap dengan parse_mode HTML
+NIGHT_SHIFT = "malam"
+
+def _in_shift_span(shift, at):
+    """Apakah titik (jam, menit) berada di rentang hari logis shift tsb.
+
+    Batas hari logis 07:00 (get_shift_info, _window_regime) dan rotasi ROTATE_AT
+    berlaku untuk semua grup, jadi shift malam harus di 23:00–06:50 dan shift
+    lain di 07:00–24:00.
+    """
+    if shift == NIGHT_SHIFT:
+        return at[0] >= 23 or at < ROTATE_AT
+    return at[0] >= 7
+
+class Schedule:
+    """Jadwal terkompilasi: indeks slot, timeline event dan aturan rotasi shift.
+
+    Dibuat lewat ``compile_schedule`` sehingga grup dengan brand/jam/rotasi yang
+    sama berbagi satu objek; tidak pernah diubah setelah dibuat.
+    """
+    __slots__ = ("slots", "timeline", "shift_points", "epoch", "shifts_order")
+
+    def __init__(self, brands, times, epoch, shifts_order):
+        self.slots = SlotIndex(brands, times)
+        self.timeline = build_timeline(self.slots.times)
+        # shift -> {(jam, menit): event milik shift tsb}: dipakai register_group
+        # dan missed_events supaya tidak menyaring timeline per grup.
+        self.shift_points = {
+            shift: {at: own for at, events in self.timeline.items()
+                    if (own := tuple(ev for ev in events if ev[1] == shift))}
+            for shift in self.slots.times
+        }
+        self.epoch = epoch
+        self.shifts_order = tuple(shifts_order)
+
+    @property
+    def brands(self):
+        return self.slots.brands
+
+    @property
+    def times(self):
+        return self.slots.times
+
+GroupConfig = namedtuple("GroupConfig", ("thread_id", "admin_tags", "schedule"))
+
+@functools.lru_cache(maxsize=None)
+def compile_schedule(brands, times, epoch, shifts_order):
+    """Validasi lalu kompilasi jadwal. `times` berupa tuple ((shift, (jam, ...)), ...)."""
+    if not brands:
+        raise ValueError("Daftar brand kosong.")
+    for brand in brands:
+        if not BRAND_RE.fullmatch(brand):
+            raise ValueError(f"Brand {brand!r} hanya boleh huruf besar dan angka.")
+    if len(set(brands)) != len(brands):
+        raise ValueError("Brand tidak boleh dobel.")
+    times = dict(times)
+    if set(times) != set(SHIFT_NAMES):
+        raise ValueError(f"Jam harus diisi untuk shift {', '.join(SHIFT_NAMES)}.")
+    for shift, jams in times.items():
+        if not jams or len(set(jams)) != len(jams):
+            raise ValueError(f"Jam shift {shift} kosong atau dobel.")
+        for jam in jams:
+            if not JAM_RE.fullmatch(jam):
+                raise ValueError(f"Jam {jam!r} tidak valid (format HH:MM).")
+        points = [parse_jam(jam) for jam in jams]
+        points += [_add_minutes(jams[0], -RESET_LEAD), _add_minutes(jams[0], -PREP_LEAD),
+                   _add_minutes(jams[-1], SUMMARY_LAG)]
+        if not all(_in_shift_span(shift, at) for at in points):
+            span = f"23:00–{ROTATE_AT[0]:02d}:{ROTATE_AT[1]:02d}" if shift == NIGHT_SHIFT else "07:00–24:00"
+            raise ValueError(f"Jam shift {shift} beserta reset, persiapan dan ringkasannya harus di {span}.")
+    if len(brands) * max(map(len, times.values())) > MAX_SLOT_BITS:
+        raise ValueError(f"Terlalu banyak brand × jam untuk satu shift (maks {MAX_SLOT_BITS}).")
+    if max(len(brands), max(map(len, times.values()))) > MAX_SLOT_COUNT:
+        raise ValueError(f"Maksimal {MAX_SLOT_COUNT} brand dan {MAX_SLOT_COUNT} jam per shift.")
+    if sorted(shifts_order) != sorted(SHIFT_NAMES):
+        raise ValueError(f"Urutan rotasi harus memuat {', '.join(SHIFT_NAMES)} masing-masing sekali.")
+    return Schedule(brands, times, epoch, shifts_order)
+
+def compile_group(raw):
+    """Ubah dict konfigurasi (boleh sebagian) menjadi GroupConfig; ValueError jika tidak valid."""
+    times = raw.get("times", TIMES)
+    schedule = compile_schedule(
+        tuple(raw.get("brands", SUBMENUS)),
+        tuple((shift, tuple(times.get(shift, ()))) for shift in SHIFT_NAMES),
+        raw.get("epoch", EPOCH_DATE),
+        tuple(raw.get("shifts_order", SHIFTS_ORDER)),
+    )
+    admin_tags = raw.get("admin_tags", DEFAULT_ADMIN_TAGS)
+    if not all(ADMIN_TAG_RE.fullmatch(tag) for tag in admin_tags.split()):
+        raise ValueError("Admin harus berupa @username Telegram, dipisah spasi.")
+    return GroupConfig(raw.get("thread_id", TARGET_THREAD_ID), admin_tags, schedule)
+
+DEFAULT_GROUP = compile_group({})
+
+# chat_id -> GroupConfig. Dibaca di jalur panas (is_target, webhook_wants)
+# tanpa menyentuh bot_data; grup target lama selalu terdaftar dengan bawaan.
+GROUPS = {TARGET_CHAT_ID: DEFAULT_GROUP}
+
+def group_config(chat_id) -> GroupConfig:
+    return GROUPS.get(chat_id, DEFAULT_GROUP)
+
+def load_group_configs(bot_data):
+    for cid, raw in bot_data.get("group_configs", {}).items():
+        try:
+            GROUPS[cid] = compile_group(raw)
+        except ValueError as e:
+            logger.error(f"Konfigurasi grup {cid} tidak valid, dilewati: {e}")
+
+def set_group_config(app, chat_id, raw):
+    """Simpan konfigurasi baru grup dan terapkan langsung (tanpa restart).
+
+    Mengembalikan (lama, baru). Jika grup sedang aktif, timeline-nya dipasang
+    ulang sesuai jam yang baru.
+    """
+    new = compile_group(raw)
+    old = group_config(chat_id)
+    configs = app.bot_data.setdefault("group_configs", {})
+    configs[chat_id] = dict(raw)
+    GROUPS[chat_id] = new
+    if chat_id in _group_events and app.job_queue:
+        install_timeline(app.job_queue, new.schedule)
+        register_group(chat_id)
+    return old, new
+
+def remap_slots(chat_data, shift, old, new):
+    """Pindahkan centang shift berjalan ke indeks slot baru (brand/jam yang hilang ikut terbuang)."""
+    if old is new:
+        return
+    mask = get_slots(chat_data, shift, old)
+    keys = [f"{brand}_{jam}" for brand, jam, bit in old.slots(shift) if mask & bit]
+    set_slots(chat_data, shift, new.from_keys(keys, shift))
+
+# ----------------------
+# Pemulihan Restart
+# ----------------------
+# Setiap grup menyimpan cursor (timestamp titik timeline terakhir yang sudah
+# diproses) di chat_data["event_cursor"]. Saat start, titik yang terlewat
+# diputar ulang menurut MISFIRE_GRACE: batas keterlambatan (detik) yang masih
+# layak dikirim; None = selalu diputar ulang selama dalam CATCHUP_HORIZON.
+CATCHUP_HORIZON = datetime.timedelta(hours=float(os.environ.get("CATCHUP_HORIZON_HOURS", 24)))
+MISFIRE_GRACE = {
+    "reset": None,   # transisi shift tidak boleh hilang
+    "prep": 3600,
+    "rekap": 3600,
+    "warn": 600,     # peringatan hanya berguna sebelum batas akhir laporan
+    "start": 300,
+}
+
+RECOVERY_INTERVAL = float(os.environ.get("RECOVERY_INTERVAL", 60))
+
+_deferred_points = []  # (titik, waktu terjadwal) yang terlewat selama lease shard lepas
+
+def event_expired(kind, late):
+    grace = MISFIRE_GRACE[kind]
+    return late > (CATCHUP_HORIZON.total_seconds() if grace is None else grace)
+
+def due_events(events, late):
+    """Event yang masih layak dikirim bila terlambat `late` detik."""
+    return tuple(ev for ev in events if not event_expired(ev[0], late))
+
+def missed_events(schedule, since, until):
+    """Titik timeline jadwal di (since, until] beserta event shift yang berlaku saat itu, urut waktu."""
+    out = []
+    day = since.date()
+    while day <= until.date():
+        for (h, m) in schedule.timeline:
+            at = datetime.datetime.combine(day, datetime.time(h, m), tzinfo=timezone)
+            if not since < at <= until:
+                continue
+            own = schedule.shift_points[rotation_shift(at, schedule)].get((h, m))
+            if own:
+                out.append((at, own))
+        day += datetime.timedelta(days=1)
+    out.sort(key=lambda e: e[0])
+    return out
+
+async def catch_up(app):
+    """Putar ulang event yang terlewat selama bot mati dan lanjutkan render jadwal yang tertunda."""
+    groups = list(_group_events)
+    if not groups:
+        return
+    context = CallbackContext(app)
+    now = now_local()
+    for cid in groups:
+        chat_data = await load_chat_data(app, cid)
+        resume_schedule_render(app.bot, cid, chat_data)
+        cursor = chat_data.get("event_cursor")
+        if cursor is None:
+            chat_data["event_cursor"] = now.timestamp()
+            continue
+        since = max(datetime.datetime.fromtimestamp(cursor, timezone), now - CATCHUP_HORIZON)
+        skipped = 0
+        for at, events in missed_events(group_config(cid).schedule, since, now):
+            late = (now - at).total_seconds()
+            due = due_events(events, late)
+            skipped += len(events) - len(due)
+            if due:
+                logger.info(f"⏪ Grup {cid}: putar ulang {', '.join(ev[0] for ev in due)} {at:%H:%M} (telat {late:.0f}s).")
+            await fire_group_events(context, cid, due, at)
+        if skipped:
+            logger.info(f"⏭️ Grup {cid}: {skipped} event terlewat sudah kedaluwarsa, dilewati.")
+    await recover_events(context)
+
+async def recover_events(context):
+    """Putar ulang titik yang tertunda saat lease lepas, lalu event yang klaimnya gagal
+    atau tertinggal oleh proses yang sudah mati (hanya untuk grup milik proses ini)."""
+    if LEASE is not None and not LEASE.holds():
+        return
+    now = now_local()
+    while _deferred_points:
+        at, scheduled = _deferred_points.pop(0)
+        late = (now - scheduled).total_seconds()
+        logger.info(f"⏪ Putar ulang titik {at[0]:02d}:{at[1]:02d} yang tertunda (telat {late:.0f}s).")
+        await run_timeline_point(context, at, scheduled, late=late)
+
+    persistence = context.application.persistence
+    if not isinstance(persistence, SQLiteStatePersistence):
+        return
+    since_day = get_shift_info(now - CATCHUP_HORIZON)[1].toordinal()
+    for cid, day, event, scheduled_ts in persistence.stale_events(since_day):
+        kind, shift, jam = event.split(":", 2)
+        if cid not in _group_events or not scheduled_ts or kind not in MISFIRE_GRACE:
+            continue
+        late = now.timestamp() - scheduled_ts
+        if event_expired(kind, late):
+            # Diambil alih dulu supaya hanya satu proses yang menandainya.
+            if persistence.claim_event(cid, day, event, scheduled_ts):
+                persistence.finish_event(cid, day, event, "expired")
+                logger.info(f"⏭️ Grup {cid}: event {event} sudah kedaluwarsa, dilewati.")
+            continue
+        logger.info(f"⏪ Grup {cid}: ulang event {event} (telat {late:.0f}s).")
+        await fire_group_events(context, cid, ((kind, shift, jam or None),),
+                                datetime.datetime.fromtimestamp(scheduled_ts, timezone))
+
+async def job_recover(context: ContextTypes.DEFAULT_TYPE):
+    await recover_events(context)
+
+# ----------------------
+# Cache Hak Admin
+# ----------------------
+ADMIN_CACHE_TTL = float(os.environ.get("ADMIN_CACHE_TTL", 600))
+ADMIN_CACHE_SIZE = int(os.environ.get("ADMIN_CACHE_SIZE", 4096))
+ADMIN_STATUSES = ("administrator", "creator")
+
+class AdminCache:
+    """Cache status admin per (chat_id, user_id) dengan TTL dan eviksi LRU.
+
+    Setelah ``warm`` dengan daftar admin lengkap sebuah chat, user yang tidak
+    ada di daftar itu dianggap bukan admin tanpa bertanya ke Telegram sampai
+    TTL habis. Update ChatMember langsung menimpa entri yang bersangkutan.
+    """
+
+    def __init__(self, ttl=ADMIN_CACHE_TTL, maxsize=ADMIN_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (chat_id, user_id) -> (is_admin, expires)
+        self._complete = {}            # chat_id -> expires daftar admin lengkap
+
+    def get(self, chat_id, user_id):
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry:
+            if entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+            del self._entries[key]
+        if self._complete.get(chat_id, 0) > now:
+            return False
+        return None
+
+    def set(self, chat_id, user_id, is_admin):
+        self._entries[(chat_id, user_id)] = (is_admin, time.monotonic() + self.ttl)
+        self._entries.move_to_end((chat_id, user_id))
+        while len(self._entries) > self.maxsize:
+            (old_chat, _), (was_admin, _) = self._entries.popitem(last=False)
+            if was_admin:
+                # Daftar admin chat itu tidak lengkap lagi di cache.
+                self._complete.pop(old_chat, None)
+
+    def warm(self, chat_id, admin_ids):
+        for user_id in admin_ids:
+            self.set(chat_id, user_id, True)
+        self._complete[chat_id] = time.monotonic() + self.ttl
+
+    def invalidate(self, chat_id, user_id=None):
+        if user_id is None:
+            self._complete.pop(chat_id, None)
+            for key in [k for k in self._entries if k[0] == chat_id]:
+                del self._entries[key]
+        else:
+            self._entries.pop((chat_id, user_id), None)
+
+ADMIN_CACHE = AdminCache()
+
+async def warm_admin_cache(bot, chat_id):
+    try:
+        admins = await bot.get_chat_administrators(chat_id)
+    except TelegramError as e:
+        logger.warning(f"Gagal ambil daftar admin grup {chat_id}: {e}")
+        return
+    ADMIN_CACHE.invalidate(chat_id)
+    ADMIN_CACHE.warm(chat_id, [a.user.id for a in admins])
+
+async def is_chat_admin(bot, chat_id, user_id) -> bool:
+    cached = ADMIN_CACHE.get(chat_id, user_id)
+    if cached is not None:
+        return cached
+    member = await bot.get_chat_member(chat_id, user_id)
+    is_admin = member.status in ADMIN_STATUSES
+    ADMIN_CACHE.set(chat_id, user_id, is_admin)
+    return is_admin
+
+def is_owner(user) -> bool:
+    return bool(user.username) and user.username.lower() == OWNER_USERNAME.lower()
+
+async def is_privileged(bot, chat_id, user) -> bool:
+    """Owner atau admin grup."""
+    return is_owner(user) or await is_chat_admin(bot, chat_id, user.id)
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cmu = update.chat_member or update.my_chat_member
+    member = cmu.new_chat_member
+    ADMIN_CACHE.set(cmu.chat.id, member.user.id, member.status in ADMIN_STATUSES)
 
 # ----------------------
 # Command Handlers
@@ -274,11 +1453,7 @@ async def say_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     thread_id = update.message.message_thread_id
     
-    member = await context.bot.get_chat_member(chat_id, user.id)
-    is_admin = member.status in ["administrator", "creator"]
-    is_owner = user.username and user.username.lower() == OWNER_USERNAME.lower()
-
-    if not (is_admin or is_owner):
+    if not await is_privileged(context.bot, chat_id, user):
         return 
 
     if not context.args:
@@ -288,25 +1463,26 @@ async def say_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try: await update.message.delete()
     except: pass
 
-    await context.bot.send_message(chat_id=chat_id, message_thread_id=thread_id, text=pesan)
+    await OUTBOX.call("reply", chat_id, context.bot.send_message, chat_id=chat_id, message_thread_id=thread_id, text=pesan)
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update): return
-    await update.message.reply_text("👋 Bot Jadwal Siap beroperasi di topik ini! Gunakan /aktifkan untuk memulai.")
+    await reply(update.message, "👋 Bot Jadwal Siap beroperasi di topik ini! Gunakan /aktifkan untuk memulai.")
 
 async def aktifkan_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update): return
     
     cid = update.effective_chat.id
-    thread_id = update.message.message_thread_id
+    cfg = group_config(cid)
     active = context.bot_data.setdefault("active_groups", set())
     active.add(cid)
     context.bot_data["active_groups"] = active
-    context.chat_data["thread_id"] = thread_id
-    schedule_group_jobs(context.job_queue, cid, thread_id)
+    install_timeline(context.job_queue, cfg.schedule)
+    register_group(cid)
+    await warm_admin_cache(context.bot, cid)
     
-    current_shift, _ = get_shift_info(datetime.datetime.now(timezone))
-    await update.message.reply_text(f"✅ Sistem DIAKTIFKAN.\nShift: *{current_shift.upper()}*", parse_mode="Markdown")
+    current_shift, _ = get_shift_info(now_local(), cfg.schedule)
+    await reply(update.message, f"✅ Sistem DIAKTIFKAN.\nShift: *{current_shift.upper()}*", parse_mode="Markdown")
     if "schedule_msg_id" not in context.chat_data:
         await send_schedule_to_chat(context.bot, cid, context.chat_data, current_shift, pin_message=True)
 
@@ -318,26 +1494,26 @@ async def nonaktifkan_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if cid in active:
         active.remove(cid)
         context.bot_data["active_groups"] = active
-        for job in context.job_queue.jobs():
-            if job.name and job.name.endswith(f"_{cid}"):
-                job.schedule_removal()
-        await update.message.reply_text("⛔ *Bot Dinonaktifkan!*", parse_mode="Markdown")
+        unregister_group(cid)
+        await reply(update.message, "⛔ *Bot Dinonaktifkan!*", parse_mode="Markdown")
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update): return
     
     cid = update.effective_chat.id
-    now = datetime.datetime.now(timezone)
-    current_shift, _ = get_shift_info(now)
+    now = now_local()
+    current_shift, _ = get_shift_info(now, group_config(cid).schedule)
     is_active = "Aktif ✅" if cid in context.bot_data.get("active_groups", set()) else "Nonaktif ❌"
-    await update.message.reply_text(f"📡 *STATUS BOT*\nStatus: {is_active}\nShift: *{current_shift.upper()}*", parse_mode="Markdown")
+    q = OUTBOX.stats()
+    await reply(update.message, f"📡 *STATUS BOT*\nStatus: {is_active}\nShift: *{current_shift.upper()}*\n"
+                f"Antrian kirim: {q['depth']} (dibuang: {sum(q['dropped'].values())})", parse_mode="Markdown")
 
 async def jadwal_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update): return
     
     cid = update.effective_chat.id
     if cid not in context.bot_data.get("active_groups", set()): return
-    current_shift, _ = get_shift_info(datetime.datetime.now(timezone))
+    current_shift, _ = get_shift_info(now_local(), group_config(cid).schedule)
     await send_schedule_to_chat(context.bot, cid, context.chat_data, current_shift)
 
 async def rekap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -345,11 +1521,117 @@ async def rekap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     cid = update.effective_chat.id
     if cid not in context.bot_data.get("active_groups", set()): return
-    current_shift, _ = get_shift_info(datetime.datetime.now(timezone))
-    skips = context.chat_data.get("skips", set())
-    terlewat = [f"❌ {sec} - {j}" for sec in SUBMENUS for j in TIMES[current_shift] if f"{sec}_{j}" not in skips]
+    schedule = group_config(cid).schedule
+    current_shift, _ = get_shift_info(now_local(), schedule)
+    mask = get_slots(context.chat_data, current_shift, schedule.slots)
+    terlewat = [f"❌ {sec} - {j}" for sec, j in schedule.slots.missing(mask, current_shift)]
     msg = f"📊 *REKAP {current_shift.upper()}*\n" + (chr(10).join(terlewat) if terlewat else "Laporan SEMPURNA! 🎉")
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    await reply(update.message, msg, parse_mode="Markdown")
+
+async def statistik_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_allowed(update): return
+
+    cid = update.effective_chat.id
+    if cid not in context.bot_data.get("active_groups", set()): return
+    try:
+        days = max(1, int(context.args[0])) if context.args else STATS_DEFAULT_DAYS
+    except ValueError:
+        await reply(update.message, "Format: /statistik [jumlah_hari]")
+        return
+    try:
+        import numpy  # noqa: F401 (dependensi opsional untuk analitik)
+    except ImportError:
+        await reply(update.message, "❌ Statistik butuh paket numpy di server.")
+        return
+
+    schedule = group_config(cid).schedule
+    since = get_shift_info(now_local(), schedule)[1].toordinal() - days + 1
+    stats = compliance_stats(HISTORY.load(), cid, since, schedule.slots)
+    if not stats:
+        await reply(update.message, f"📈 Belum ada riwayat shift dalam {days} hari terakhir.")
+        return
+
+    worst_brands = sorted(stats["per_brand"].items(), key=lambda kv: -kv[1])[:3]
+    worst_hours = sorted(stats["per_hour"].items(), key=lambda kv: -kv[1])[:3]
+    msg = (f"📈 *STATISTIK KEPATUHAN ({days} hari)*\n"
+           f"Shift tercatat: {stats['shifts']}\n"
+           f"Tingkat terlewat: {stats['miss_rate']:.1%}\n"
+           f"Streak sempurna: {stats['perfect_streak']} shift (terbaik {stats['best_streak']})\n\n"
+           f"*Brand paling sering terlewat:*\n"
+           + "\n".join(f"• {b}: {r:.1%}" for b, r in worst_brands) + "\n\n"
+           f"*Jam paling rawan:*\n"
+           + "\n".join(f"• {j}: {r:.1%}" for j, r in worst_hours) + "\n\n"
+           f"*Tren mingguan:* " + " → ".join(f"{w:.0%}" for w in stats["weekly"]))
+    await reply(update.message, msg, parse_mode="Markdown")
+
+def describe_group(cfg):
+    schedule = cfg.schedule
+    lines = [f"Topik: {cfg.thread_id}",
+             f"Brand: {' '.join(schedule.brands)}",
+             f"Epoch rotasi: {schedule.epoch.isoformat()}",
+             f"Urutan rotasi: {' → '.join(schedule.shifts_order)}",
+             f"Admin: {cfg.admin_tags}"]
+    lines += [f"Jam {shift}: {' '.join(jams)}" for shift, jams in schedule.times.items()]
+    return "\n".join(lines)
+
+async def atur_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lihat/ubah konfigurasi grup. Grup atau topik yang belum terdaftar hanya bisa diatur pemilik bot.
+
+    /atur | /atur topik | /atur brand A B .. | /atur jam <shift> 08:00 .. |
+    /atur epoch YYYY-MM-DD | /atur urutan pagi malam siang | /atur admin @a @b | /atur default
+    """
+    if not update.effective_chat or not update.message: return
+
+    cid = update.effective_chat.id
+    user = update.effective_user
+    if cid not in GROUPS or not is_allowed(update):
+        if not is_owner(user): return
+    elif not await is_privileged(context.bot, cid, user):
+        return
+
+    if not context.args:
+        await reply(update.message, f"⚙️ Konfigurasi grup\n{describe_group(group_config(cid))}")
+        return
+
+    key, values = context.args[0].lower(), [v for arg in context.args[1:] for v in arg.split(",") if v]
+    configs = context.bot_data.get("group_configs", {})
+    raw = dict(configs.get(cid, {"thread_id": group_config(cid).thread_id}))
+    if key == "topik":
+        raw["thread_id"] = update.message.message_thread_id
+    elif key == "brand" and values:
+        raw["brands"] = [v.upper() for v in values]
+    elif key == "jam" and len(values) > 1 and values[0] in SHIFT_NAMES:
+        times = {shift: list(jams) for shift, jams in group_config(cid).schedule.times.items()}
+        times[values[0]] = values[1:]
+        raw["times"] = times
+    elif key == "epoch" and len(values) == 1:
+        try:
+            raw["epoch"] = datetime.date.fromisoformat(values[0])
+        except ValueError:
+            await reply(update.message, "❌ Format tanggal: YYYY-MM-DD")
+            return
+    elif key == "urutan" and values:
+        raw["shifts_order"] = values
+    elif key == "admin" and values:
+        raw["admin_tags"] = " ".join(values)
+    elif key == "default":
+        raw = {"thread_id": raw["thread_id"]}
+    else:
+        await reply(update.message, "Format: /atur [topik | brand .. | jam <shift> .. | epoch YYYY-MM-DD | urutan .. | admin .. | default]")
+        return
+
+    try:
+        old, new = set_group_config(context.application, cid, raw)
+    except ValueError as e:
+        await reply(update.message, f"❌ {e}")
+        return
+
+    if old.schedule is not new.schedule:
+        shift, _ = get_shift_info(now_local(), new.schedule)
+        remap_slots(context.chat_data, shift, old.schedule.slots, new.schedule.slots)
+        if cid in context.bot_data.get("active_groups", set()) and "schedule_msg_id" in context.chat_data:
+            request_schedule_render(context.bot, cid, context.chat_data, shift)
+    await reply(update.message, f"✅ Konfigurasi disimpan.\n{describe_group(new)}")
 
 # ----------------------
 # Tombol & Auto Check
@@ -357,114 +1639,1084 @@ async def rekap_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
-    # Keamanan tambahan: Pastikan tombol hanya bisa ditekan di grup target (meskipun callback query tidak memiliki thread_id di Telegram saat ini)
-    if query.message.chat.id != TARGET_CHAT_ID:
+    # Keamanan tambahan: Pastikan tombol hanya bisa ditekan di grup terdaftar (meskipun callback query tidak memiliki thread_id di Telegram saat ini)
+    if query.message.chat.id not in GROUPS:
         await query.answer("Aksi tidak diizinkan di grup ini.", show_alert=True)
         return
 
-    user = query.from_user
-    is_owner = user.username and user.username.lower() == OWNER_USERNAME.lower()
-    
-    if not is_owner:
+    data = query.data
+    if data.startswith("page_"):
+        # Pindah halaman boleh untuk semua anggota: hanya tampilan yang berubah.
+        cid = query.message.chat.id
+        context.chat_data["schedule_page"] = int(data[len("page_"):])
+        await query.answer()
+        current_shift, _ = get_shift_info(now_local(), group_config(cid).schedule)
+        await send_schedule_to_chat(context.bot, cid, context.chat_data, current_shift,
+                                    message_id=query.message.message_id, kind="edit")
+        return
+
+    # Centang manual hanya untuk pemilik bot (seperti semula); admin grup tidak.
+    if not is_owner(query.from_user):
         await query.answer("❌ Centang otomatis. Kirim foto bukti!", show_alert=True)
         return
 
-    data = query.data
     if data.startswith("toggle_"):
         _, sec, jam = data.split("_")
         chat_data = context.chat_data 
-        skips = chat_data.setdefault("skips", set())
-        key = f"{sec}_{jam}"
-        if key in skips: skips.remove(key)
-        else: skips.add(key)
+        schedule = group_config(query.message.chat.id).schedule
+        slots = schedule.slots
+        current_shift, _ = get_shift_info(now_local(), schedule)
+        bit = slots.bit(current_shift, sec, jam)
+        if not bit:
+            await query.answer("Jadwal ini bukan milik shift aktif.", show_alert=True)
+            return
+        set_slots(chat_data, current_shift, slots.toggle(get_slots(chat_data, current_shift, slots), bit))
         await query.answer("Berhasil diperbarui!")
-        current_shift, _ = get_shift_info(datetime.datetime.now(timezone))
-        await send_schedule_to_chat(context.bot, query.message.chat.id, chat_data, current_shift, message_id=query.message.message_id)
+        request_schedule_render(context.bot, query.message.chat.id, chat_data, current_shift, message_id=query.message.message_id)
 
 async def auto_check_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Menggunakan is_allowed sebagai ganti pengecekan manual sebelumnya
     if not is_allowed(update): return
 
     msg = update.message
-    if not msg or not (msg.text or msg.caption): return
+    text = msg.text or msg.caption
+    if not text: return
+    # Jalur tolak murah: obrolan biasa berhenti di sini tanpa upper() / regex penuh.
+    if not REPORT_MARK.search(text): return
     chat_id = update.effective_chat.id
     if chat_id not in context.bot_data.get("active_groups", set()): return
 
-    text = (msg.text or msg.caption).upper()
-    if "TEST DAFTAR" in text:
-        if not msg.photo and not msg.document:
-            await msg.reply_text("❌ Wajib lampirkan foto/file!")
+    if not msg.photo and not msg.document:
+        await reply(msg, "❌ Wajib lampirkan foto/file!")
+        return
+
+    pairs = parse_reports(text)
+    if not pairs:
+        await reply(msg, "❌ Format laporan tidak terbaca. Sertakan BRAND: <brand> dan WAKTU: HH:MM.")
+        return
+
+    now = now_local()
+    schedule = group_config(chat_id).schedule
+    slots = schedule.slots
+    current_shift, _ = get_shift_info(now, schedule)
+    windows = acceptance_windows(slots.times[current_shift], now.date(), _window_regime(now))
+    mask = get_slots(context.chat_data, current_shift, slots)
+    ticked = 0
+    lines = []
+
+    for sec, jam in pairs:
+        bit = slots.bit(current_shift, sec, jam)
+        if not bit:
+            continue
+        start_window, end_window = windows[jam]
+        if now < start_window:
+            lines.append(f"⏳ Terlalu cepat! Laporan {jam} baru bisa dikirim mulai {start_window.strftime('%H:%M')}.")
+        elif now > end_window:
+            lines.append(f"⏰ Terlambat! Laporan {jam} sudah ditutup (Maksimal {end_window.strftime('%H:%M')}).")
+        elif not (mask | ticked) & bit:
+            ticked |= bit
+            lines.append(f"✅ {sec} {jam} Diterima!")
+
+    # Semua centang dari satu pesan = satu perubahan state + satu render.
+    if ticked:
+        set_slots(context.chat_data, current_shift, mask | ticked)
+        request_schedule_render(context.bot, chat_id, context.chat_data, current_shift)
+    if lines:
+        await reply(msg, "\n".join(lines))
+
+# ----------------------
+# Persistensi (SQLite WAL)
+# ----------------------
+class SQLiteStatePersistence(BasePersistence):
+    """Persistensi inkremental di SQLite (mode WAL).
+
+    Setiap chat disimpan sebagai satu baris: kolom ``slots`` berisi bitmask
+    laporan (BLOB little-endian, karena INTEGER SQLite hanya 64 bit bertanda)
+    dan ``data`` berisi pickle sisa ``chat_data``. Hanya baris yang
+    benar-benar berubah yang ditulis, dan semua perubahan dari satu putaran
+    ``update_persistence`` digabung menjadi satu transaksi. ``chat_data``
+    dimuat lazy: baru dibaca dari disk saat chat tersebut pertama kali diakses
+    (lewat ``refresh_chat_data``).
+
+    Dengan ``shard`` terisi (mode cluster) beberapa proses berbagi file yang
+    sama: ``chat_data`` sudah terpisah per grup, sedangkan ``bot_data`` disimpan
+    per shard supaya worker tidak saling menimpa ``active_groups``.
+    """
+
+    def __init__(self, filepath=STATE_DB, update_interval=PERSIST_INTERVAL, shard=None):
+        super().__init__(store_data=PersistenceInput(), update_interval=update_interval)
+        self.filepath = filepath
+        self.shard = shard
+        self._db = sqlite3.connect(filepath, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, slots BLOB NOT NULL DEFAULT x'', data BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS bot_data (key BLOB PRIMARY KEY, value BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS fired_events (chat_id INTEGER NOT NULL, day INTEGER NOT NULL, event TEXT NOT NULL,"
+            " owner TEXT NOT NULL DEFAULT '', status TEXT NOT NULL DEFAULT 'done', scheduled REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (chat_id, day, event)) WITHOUT ROWID;"
+            # Dibuat juga di sini (bukan hanya oleh ShardLease) supaya claim_event
+            # bisa memeriksa pemilik yang masih hidup di mode satu proses.
+            "CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(fired_events)")}
+        for column, ddl in (("owner", "TEXT NOT NULL DEFAULT ''"), ("status", "TEXT NOT NULL DEFAULT 'done'"),
+                            ("scheduled", "REAL NOT NULL DEFAULT 0")):
+            if column not in columns:
+                # File dari versi lama: klaim lama dianggap sudah selesai.
+                self._db.execute(f"ALTER TABLE fired_events ADD COLUMN {column} {ddl}")
+        self.owner = PROCESS_OWNER
+        self._loaded = set()     # chat_id yang sudah dimuat ke memori
+        self._chat_rows = {}     # chat_id -> (slots, blob) terakhir di disk
+        self._user_rows = {}     # user_id -> blob
+        self._bot_rows = {}      # key pickle -> value pickle
+        self._meta_rows = {}
+        self._pending = []       # (sql, params) menunggu commit
+        self._commit_scheduled = False
+
+    @staticmethod
+    def _dumps(obj):
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _pack_slots(mask):
+        return mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+
+    @staticmethod
+    def _unpack_slots(value):
+        # Baris dari versi lama masih menyimpan INTEGER.
+        return value if isinstance(value, int) else int.from_bytes(value, "little")
+
+    def _queue(self, sql, params):
+        self._pending.append((sql, params))
+        if not self._commit_scheduled:
+            self._commit_scheduled = True
+            # call_soon jalan setelah semua coroutine update_* di putaran ini
+            # selesai, sehingga satu putaran update_persistence = satu transaksi.
+            asyncio.get_running_loop().call_soon(self._commit)
+
+    def _commit(self):
+        self._commit_scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        start = time.perf_counter()
+        try:
+            self._execute_batch(pending)
+        except Exception as e:
+            # Satu baris bermasalah (OverflowError, error pickle, dsb.) tidak boleh
+            # membuang seluruh putaran: ulangi per statement dan lewati yang gagal.
+            logger.error(f"Gagal menulis state ke SQLite ({e}), diulang per baris.")
+            for sql, params in pending:
+                try:
+                    self._db.execute(sql, params)
+                except Exception as e:
+                    logger.error(f"Baris state dilewati: {e}")
+        METRICS.observe("regist_persistence_flush_seconds", time.perf_counter() - start)
+
+    def _execute_batch(self, pending):
+        try:
+            self._db.execute("BEGIN")
+            for sql, params in pending:
+                self._db.execute(sql, params)
+            self._db.execute("COMMIT")
+        finally:
+            # Transaksi yang tertinggal terbuka membuat setiap BEGIN berikutnya gagal.
+            if self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+
+    def _put_meta(self, key, value):
+        blob = self._dumps(value)
+        if self._meta_rows.get(key) != blob:
+            self._meta_rows[key] = blob
+            self._queue("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, blob))
+
+    def _get_meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return default
+        self._meta_rows[key] = row[0]
+        return pickle.loads(row[0])
+
+    def has_data(self):
+        row = self._db.execute(
+            "SELECT EXISTS (SELECT 1 FROM bot_data) OR EXISTS (SELECT 1 FROM chat_data)"
+        ).fetchone()
+        return bool(row[0])
+
+    # --- chat_data ---
+    async def get_chat_data(self):
+        # Sengaja kosong: isi tiap chat dimuat saat refresh_chat_data pertama.
+        return {}
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if chat_id in self._loaded:
+            return
+        self._loaded.add(chat_id)
+        row = self._db.execute("SELECT slots, data FROM chat_data WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row:
+            slots = self._unpack_slots(row[0])
+            self._chat_rows[chat_id] = (slots, row[1])
+            chat_data.update(pickle.loads(row[1]))
+            chat_data["slots"] = slots
+
+    async def update_chat_data(self, chat_id, data):
+        if chat_id not in self._loaded and not data:
+            return
+        data = dict(data)
+        slots = data.pop("slots", 0)
+        blob = self._dumps(data)
+        old = self._chat_rows.get(chat_id)
+        if old == (slots, blob):
+            return
+        self._chat_rows[chat_id] = (slots, blob)
+        if old and old[1] == blob:
+            # Hanya bit laporan yang berubah: blob tidak perlu ditulis ulang.
+            self._queue("UPDATE chat_data SET slots = ? WHERE chat_id = ?", (self._pack_slots(slots), chat_id))
+        else:
+            self._queue("INSERT OR REPLACE INTO chat_data (chat_id, slots, data) VALUES (?, ?, ?)",
+                        (chat_id, self._pack_slots(slots), blob))
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded.discard(chat_id)
+        self._chat_rows.pop(chat_id, None)
+        self._queue("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    # --- user_data ---
+    async def get_user_data(self):
+        data = {}
+        for user_id, blob in self._db.execute("SELECT user_id, data FROM user_data"):
+            self._user_rows[user_id] = blob
+            data[user_id] = pickle.loads(blob)
+        return data
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        blob = self._dumps(data)
+        if self._user_rows.get(user_id) != blob:
+            self._user_rows[user_id] = blob
+            self._queue("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", (user_id, blob))
+
+    async def drop_user_data(self, user_id):
+        self._user_rows.pop(user_id, None)
+        self._queue("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    # --- bot_data (satu baris per key; key shard berbentuk ("shard", n, key)) ---
+    @staticmethod
+    def _is_shard_key(k):
+        return isinstance(k, tuple) and len(k) == 3 and k[0] == "shard"
+
+    async def get_bot_data(self):
+        data, unsharded = {}, {}
+        for key, value in self._db.execute("SELECT key, value FROM bot_data"):
+            k = pickle.loads(key)
+            if self.shard is None and not self._is_shard_key(k):
+                self._bot_rows[key] = value
+                data[k] = pickle.loads(value)
+            elif self.shard is not None and self._is_shard_key(k) and k[1] == self.shard:
+                self._bot_rows[key] = value
+                data[k[2]] = pickle.loads(value)
+            elif self.shard is not None and not self._is_shard_key(k):
+                unsharded[k] = pickle.loads(value)
+        if self.shard is not None and not data:
+            # Pertama kali jalan sebagai worker: ambil bagian shard ini dari state mode satu proses.
+            data = shard_bot_data(unsharded, self.shard)
+        return data
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_bot_data(self, data):
+        seen = set()
+        for k, v in data.items():
+            key = self._dumps(k if self.shard is None else ("shard", self.shard, k))
+            value = self._dumps(v)
+            seen.add(key)
+            if self._bot_rows.get(key) != value:
+                self._bot_rows[key] = value
+                self._queue("INSERT OR REPLACE INTO bot_data (key, value) VALUES (?, ?)", (key, value))
+        for key in set(self._bot_rows) - seen:
+            del self._bot_rows[key]
+            self._queue("DELETE FROM bot_data WHERE key = ?", (key,))
+
+    # --- event terjadwal (sekali jalan lintas proses) ---
+    # Status klaim: claimed (sedang dikirim pemiliknya), done (pesan sudah diterima
+    # Bot API), failed (handler gagal, boleh diulang), expired (lewat MISFIRE_GRACE).
+    # Klaim "claimed" milik proses yang sudah mati (tidak memegang lease aktif)
+    # boleh diambil alih; lihat recover_events.
+    _RECLAIMABLE = ("(status = 'failed' OR (status = 'claimed' AND owner != ?"
+                    " AND owner NOT IN (SELECT owner FROM leases WHERE expires > ?)))")
+
+    def claim_event(self, chat_id, day, event, scheduled=0.0):
+        """Klaim event terjadwal grup untuk hari logis `day`; False jika sudah selesai
+        atau sedang dikerjakan proses yang masih hidup.
+
+        Ditulis langsung (autocommit), bukan lewat antrian ``_pending``, supaya
+        klaim sudah terlihat worker lain sebelum pesannya dikirim.
+        """
+        cur = self._db.execute(
+            "INSERT OR IGNORE INTO fired_events (chat_id, day, event, owner, status, scheduled) VALUES (?, ?, ?, ?, 'claimed', ?)",
+            (chat_id, day, event, self.owner, scheduled),
+        )
+        if cur.rowcount == 1:
+            return True
+        cur = self._db.execute(
+            f"UPDATE fired_events SET owner = ?, status = 'claimed' WHERE chat_id = ? AND day = ? AND event = ? AND {self._RECLAIMABLE}",
+            (self.owner, chat_id, day, event, self.owner, time.time()),
+        )
+        return cur.rowcount == 1
+
+    def finish_event(self, chat_id, day, event, status):
+        """Tandai klaim milik proses ini sebagai done/failed/expired."""
+        self._db.execute(
+            "UPDATE fired_events SET status = ? WHERE chat_id = ? AND day = ? AND event = ? AND owner = ?",
+            (status, chat_id, day, event, self.owner),
+        )
+
+    def stale_events(self, since_day):
+        """Klaim yang perlu diulang: gagal, atau tertinggal oleh proses yang sudah mati."""
+        return self._db.execute(
+            f"SELECT chat_id, day, event, scheduled FROM fired_events WHERE day >= ? AND {self._RECLAIMABLE}",
+            (since_day, self.owner, time.time()),
+        ).fetchall()
+
+    def prune_events(self, before_day):
+        self._db.execute("DELETE FROM fired_events WHERE day < ?", (before_day,))
+
+    # --- callback_data & conversations ---
+    async def get_callback_data(self):
+        return self._get_meta("callback_data")
+
+    async def update_callback_data(self, data):
+        self._put_meta("callback_data", data)
+
+    async def get_conversations(self, name):
+        return self._get_meta(f"conv:{name}", {})
+
+    async def update_conversation(self, name, key, new_state):
+        convs = self._get_meta(f"conv:{name}", {})
+        if new_state is None:
+            convs.pop(key, None)
+        else:
+            convs[key] = new_state
+        self._put_meta(f"conv:{name}", convs)
+
+    async def flush(self):
+        self._commit()
+        try:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logger.error(f"Gagal checkpoint WAL: {e}")
+
+    async def import_pickle(self, bot, filepath=PICKLE_FILE):
+        """Impor satu kali state dari PicklePersistence lama, lalu ganti nama file pickle-nya."""
+        old = PicklePersistence(filepath=filepath)
+        old.set_bot(bot)
+        for chat_id, data in (await old.get_chat_data() or {}).items():
+            self._loaded.add(chat_id)
+            await self.update_chat_data(chat_id, data)
+        for user_id, data in (await old.get_user_data() or {}).items():
+            await self.update_user_data(user_id, data)
+        await self.update_bot_data(await old.get_bot_data() or {})
+        self._commit()
+        self._loaded.clear()
+        os.replace(filepath, f"{filepath}.imported")
+        logger.info(f"📦 State lama {filepath} diimpor ke {self.filepath}.")
+
+async def load_chat_data(app, chat_id):
+    """Ambil chat_data grup dari luar handler (mis. job), dimuat dari persistensi jika belum."""
+    chat_data = app.chat_data[chat_id]
+    if app.persistence:
+        await app.persistence.refresh_chat_data(chat_id, chat_data)
+    app.mark_data_for_update_persistence(chat_ids=chat_id)
+    return chat_data
+
+# ----------------------
+# Riwayat Kepatuhan
+# ----------------------
+STATS_DEFAULT_DAYS = 30
+HISTORY_MASK_BYTES = MAX_SLOT_BITS // 8
+
+# Satu record lebar tetap per (grup, tanggal logis, shift). Jumlah brand dan
+# slot ikut disimpan supaya bit bisa dibentuk ulang menjadi matriks brand × slot.
+HISTORY_RECORD = struct.Struct(f"<qiBBBx{HISTORY_MASK_BYTES}s")
+HISTORY_SHIFTS = tuple(TIMES)  # kode shift di record = indeks di tuple ini
+
+class HistoryStore:
+    """Arsip append-only status slot akhir setiap shift.
+
+    File berisi record ``HISTORY_RECORD`` berurutan tanpa header, sehingga bisa
+    langsung di-memory-map sebagai array terstruktur NumPy untuk analitik.
+    """
+
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+
+    def append(self, chat_id, day, shift, mask, slot_index=None):
+        slot_index = slot_index or SLOTS
+        record = HISTORY_RECORD.pack(
+            chat_id, day.toordinal(), HISTORY_SHIFTS.index(shift),
+            len(slot_index.brands), slot_index.n_slots,
+            mask.to_bytes(HISTORY_MASK_BYTES, "little"),
+        )
+        with open(self.path, "ab") as f:
+            f.write(record)
+
+    @staticmethod
+    def dtype():
+        import numpy as np
+        return np.dtype([
+            ("chat_id", "<i8"), ("day", "<i4"), ("shift", "u1"),
+            ("brands", "u1"), ("slots", "u1"), ("pad", "u1"),
+            ("bits", "u1", (HISTORY_MASK_BYTES,)),
+        ])
+
+    def load(self):
+        """Seluruh arsip sebagai memmap read-only (atau array kosong)."""
+        import numpy as np
+        dtype = self.dtype()
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        count = size // dtype.itemsize
+        if not count:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", shape=(count,))
+
+HISTORY = HistoryStore()
+
+def archive_shift(chat_id, chat_data):
+    """Arsipkan status slot shift yang baru selesai (dipanggil sebelum reset)."""
+    day, shift = chat_data.get("slot_day"), chat_data.get("slot_shift")
+    if day is None or shift not in HISTORY_SHIFTS:
+        return
+    try:
+        slots = group_config(chat_id).schedule.slots
+        HISTORY.append(chat_id, datetime.date.fromordinal(day), shift, get_slots(chat_data, shift, slots), slots)
+    except OSError as e:
+        logger.error(f"Gagal arsip riwayat grup {chat_id}: {e}")
+
+def compliance_stats(records, chat_id, since_day, slot_index=None):
+    """Hitung statistik kepatuhan satu grup dengan agregasi NumPy.
+
+    Mengembalikan None bila tidak ada record pada rentang tsb.
+    """
+    import numpy as np
+    slot_index = slot_index or SLOTS
+    n_brands, n_slots = len(slot_index.brands), slot_index.n_slots
+    rows = records[(records["chat_id"] == chat_id) & (records["day"] >= since_day)
+                   & (records["brands"] == n_brands) & (records["slots"] == n_slots)]
+    if not len(rows):
+        return None
+    rows = rows[np.lexsort((rows["shift"], rows["day"]))]
+
+    bits = np.unpackbits(rows["bits"], axis=1, bitorder="little")[:, :n_brands * n_slots]
+    done = bits.reshape(-1, n_brands, n_slots).astype(bool)
+    shift_codes = rows["shift"]
+
+    # Slot yang tidak dipakai shift-nya (jika panjang TIMES berbeda) tidak dihitung.
+    valid = np.zeros((len(HISTORY_SHIFTS), n_slots), dtype=bool)
+    for code, shift in enumerate(HISTORY_SHIFTS):
+        valid[code, :len(slot_index.times[shift])] = True
+    valid_rows = valid[shift_codes][:, None, :]
+    missed = valid_rows & ~done
+
+    per_brand = missed.sum(axis=(0, 2)) / np.maximum(valid_rows.sum(axis=(0, 2)) * 1.0, 1)
+    per_hour = {}
+    for code, shift in enumerate(HISTORY_SHIFTS):
+        sel = shift_codes == code
+        if not sel.any():
+            continue
+        rate = missed[sel].sum(axis=(0, 1)) / (sel.sum() * n_brands)
+        for i, jam in enumerate(slot_index.times[shift]):
+            per_hour[jam] = float(rate[i])
+
+    perfect = ~missed.any(axis=(1, 2))
+    # Streak terpanjang: panjang run True terpanjang di `perfect`.
+    padded = np.concatenate(([0], perfect.astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(padded))
+    runs = edges[1::2] - edges[::2]
+    current = len(perfect) - (np.flatnonzero(~perfect)[-1] + 1) if (~perfect).any() else len(perfect)
+
+    # Tren mingguan: tingkat miss per minggu sejak `since_day`.
+    weeks = (rows["day"] - since_day) // 7
+    slots_per_row = valid_rows.sum(axis=(1, 2)) * n_brands
+    weekly_missed = np.bincount(weeks, weights=missed.sum(axis=(1, 2)))
+    weekly_total = np.bincount(weeks, weights=slots_per_row)
+    weekly = weekly_missed[weekly_total > 0] / weekly_total[weekly_total > 0]
+
+    return {
+        "shifts": int(len(rows)),
+        "miss_rate": float(missed.sum() / max(slots_per_row.sum(), 1)),
+        "per_brand": dict(zip(slot_index.brands, map(float, per_brand))),
+        "per_hour": per_hour,
+        "perfect_streak": int(current),
+        "best_streak": int(runs.max()) if len(runs) else 0,
+        "weekly": [float(w) for w in weekly],
+    }
+
+# ----------------------
+# Pemrosesan Update Paralel (Lajur per Chat)
+# ----------------------
+LANE_MAX_CONCURRENT = int(os.environ.get("LANE_MAX_CONCURRENT", 256))
+LANE_QUEUE_SIZE = int(os.environ.get("LANE_QUEUE_SIZE", 32))
+LANE_IDLE_SECONDS = float(os.environ.get("LANE_IDLE_SECONDS", 60))
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """Update dari chat berbeda diproses paralel, update dari chat yang sama tetap berurutan.
+
+    Setiap chat punya lajur sendiri (antrian terbatas + satu worker), sehingga
+    ``slots`` dan ``schedule_msg_id`` satu grup tidak pernah diubah dua handler
+    sekaligus. Lajur yang menganggur lebih dari ``idle_timeout`` dibuang.
+
+    Semaphore global ``max_concurrent_updates`` hanya dipegang selama handler
+    benar-benar jalan (di worker lajur), bukan selama update menunggu di lajur,
+    supaya satu chat yang ramai/lambat tidak menghabiskan slot chat lain.
+
+    PTB sudah membuat satu task per update sebelum ``process_update``, jadi
+    menunggu di lajur yang penuh hanya memindahkan antrian ke task yang
+    menggantung. Update untuk lajur yang penuh dibuang dan dihitung di
+    ``dropped``.
+    """
+
+    def __init__(self, max_concurrent_updates=LANE_MAX_CONCURRENT,
+                 lane_size=LANE_QUEUE_SIZE, idle_timeout=LANE_IDLE_SECONDS):
+        super().__init__(max_concurrent_updates)
+        self.lane_size = lane_size
+        self.idle_timeout = idle_timeout
+        self._lanes = {}  # chat_id -> (asyncio.Queue, worker task)
+        self.dropped = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for queue, _ in list(self._lanes.values()):
+            await queue.join()
+        for _, worker in list(self._lanes.values()):
+            worker.cancel()
+        self._lanes.clear()
+
+    async def process_update(self, update, coroutine):
+        # Menggantikan BaseUpdateProcessor.process_update, yang memegang semaphore
+        # selama do_process_update (termasuk selama menunggu di lajur).
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await super().process_update(update, coroutine)
             return
 
-        brand_match = re.search(r'BRAND\s*:\s*([A-Z0-9]+)', text)
-        waktu_match = re.search(r'WAKTU\s*:\s*(\d{2}:\d{2})', text)
-
-        if brand_match and waktu_match:
-            sec, jam = brand_match.group(1).strip(), waktu_match.group(1).strip()
-            now = datetime.datetime.now(timezone)
-            
-            target_dt = get_target_datetime(jam, now)
-            start_window = target_dt - datetime.timedelta(minutes=10)
-            end_window = target_dt + datetime.timedelta(minutes=30)
-            
-            if not (start_window <= now <= end_window):
-                if now < start_window:
-                    await msg.reply_text(f"⏳ Terlalu cepat! Laporan {jam} baru bisa dikirim mulai {start_window.strftime('%H:%M')}.")
-                else:
-                    await msg.reply_text(f"⏰ Terlambat! Laporan {jam} sudah ditutup (Maksimal {end_window.strftime('%H:%M')}).")
+        lane = self._lanes.get(chat.id)
+        if lane is None:
+            queue = asyncio.Queue(self.lane_size)
+            worker = asyncio.create_task(self._lane_worker(chat.id, queue))
+            lane = self._lanes[chat.id] = (queue, worker)
+
+        done = asyncio.get_running_loop().create_future()
+        try:
+            lane[0].put_nowait((update, coroutine, done))
+        except asyncio.QueueFull:
+            coroutine.close()
+            self.dropped += 1
+            logger.warning(f"Lajur chat {chat.id} penuh ({self.lane_size}), update {update.update_id} dibuang.")
+            return
+        # Ditunggu tanpa slot global, supaya update_queue.task_done (dan app.stop)
+        # tetap menandai selesainya handler, bukan sekadar masuk lajur.
+        await done
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def _lane_worker(self, chat_id, queue):
+        while True:
+            try:
+                update, coroutine, done = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._lanes.pop(chat_id, None)
+                    return
+                continue
+            try:
+                await super().process_update(update, coroutine)
+            except Exception as e:
+                done.set_exception(e)
+            else:
+                done.set_result(None)
+            finally:
+                queue.task_done()
+
+# ----------------------
+# Webhook
+# ----------------------
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+
+_MESSAGE_KEYS = ("message", "edited_message")
+_CHAT_KEYS = ("my_chat_member", "chat_member", "chat_join_request")
+
+WEBHOOK_STATS = {"accepted": 0, "filtered": 0, "unauthorized": 0, "overflow": 0}
+
+class UpdateQueue(asyncio.Queue):
+    """update_queue Application yang membatasi update yang belum selesai diproses.
+
+    Fetcher PTB langsung memindahkan setiap update ke task tersendiri, jadi batas
+    ``maxsize`` biasa tidak pernah penuh. Di sini ``put`` menunggu sampai jumlah
+    update yang belum ``task_done`` di bawah ``limit``; webhook_ingest ikut
+    tertahan, antrian ``updates`` terisi dan webhook menjawab 503.
+    """
+
+    def __init__(self, limit=WEBHOOK_QUEUE_SIZE):
+        super().__init__()
+        self._slots = asyncio.Semaphore(limit)
+
+    async def put(self, item):
+        await self._slots.acquire()
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self._slots.release()
+
+def webhook_wants(data) -> bool:
+    """Saring update mentah (dict JSON) sebelum dibuat objek Update.
+
+    Pesan harus dari chat dan topik yang diizinkan (sama seperti is_allowed),
+    kecuali /atur yang dipakai pemilik bot untuk mendaftarkan grup baru;
+    callback query dan update anggota cukup dicek chat-nya.
+    """
+    for key in _MESSAGE_KEYS:
+        m = data.get(key)
+        if m is not None:
+            return (is_target(m.get("chat", {}).get("id"), m.get("message_thread_id"))
+                    or (m.get("text") or "").startswith("/atur"))
+    cq = data.get("callback_query")
+    if cq is not None:
+        return (cq.get("message") or {}).get("chat", {}).get("id") in GROUPS
+    for key in _CHAT_KEYS:
+        m = data.get(key)
+        if m is not None:
+            return m.get("chat", {}).get("id") in GROUPS
+    return False
+
+async def handle_root(request): return web.Response(text="Running")
+async def handle_metrics(request): return web.Response(text=METRICS.render())
+
+def register_metric_collectors(app):
+    @METRICS.collector
+    def queues():
+        q = OUTBOX.stats()
+        yield "regist_update_queue_depth", {}, app.update_queue.qsize()
+        yield "regist_outbox_depth", {}, q["depth"]
+        for result in ("sent", "failed", "retried"):
+            yield "regist_outbox_events_total", {"result": result}, q[result]
+        for kind, n in q["dropped"].items():
+            yield "regist_outbox_events_total", {"result": "dropped", "kind": kind}, n
+        for result, n in WEBHOOK_STATS.items():
+            yield "regist_webhook_requests_total", {"result": result}, n
+        yield "regist_lane_dropped_total", {}, getattr(app.update_processor, "dropped", 0)
+        for stage, seconds in STARTUP.stages:
+            yield "regist_startup_seconds", {"stage": stage}, round(seconds, 4)
+
+def webhook_authorized(request) -> bool:
+    return not WEBHOOK_SECRET or hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+    )
+
+async def handle_webhook(request):
+    if not webhook_authorized(request):
+        WEBHOOK_STATS["unauthorized"] += 1
+        return web.Response(status=403)
+    if LEASE is not None and not LEASE.holds():
+        # Worker ini belum/tidak lagi memegang shard-nya: biar Telegram mengulang.
+        return web.Response(status=503)
+    if not request.app['ready'].is_set():
+        # Web server sudah hidup (health check) tapi konfigurasi grup belum dimuat.
+        return web.Response(status=503)
+
+    try:
+        data = json.loads(await request.read())
+    except ValueError:
+        return web.Response(status=400)
+
+    if not webhook_wants(data):
+        # Tetap 200 supaya Telegram tidak mengirim ulang update yang memang kita abaikan.
+        WEBHOOK_STATS["filtered"] += 1
+        return web.Response()
+
+    try:
+        request.app['updates'].put_nowait(data)
+    except asyncio.QueueFull:
+        # Antrian penuh: minta Telegram mengulang nanti daripada menumpuk di memori.
+        WEBHOOK_STATS["overflow"] += 1
+        return web.Response(status=503)
+    WEBHOOK_STATS["accepted"] += 1
+    return web.Response()
+
+async def webhook_ingest(app, updates):
+    """Deserialisasi update di luar jalur request, lalu teruskan ke Application."""
+    while True:
+        data = await updates.get()
+        try:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        except Exception as e:
+            logger.error(f"Update tidak valid dibuang: {e}")
+        finally:
+            updates.task_done()
+
+# ----------------------
+# Cluster (Sharding)
+# ----------------------
+# CLUSTER_WORKERS=N menjalankan N proses worker; grup dibagi per shard
+# chat_id % N. Proses front end menerima webhook Telegram lalu meneruskan
+# update mentah ke worker shard-nya. State ada di satu file SQLite bersama.
+CLUSTER_WORKERS = int(os.environ.get("CLUSTER_WORKERS", 0))  # 0 = satu proses
+CLUSTER_ROLE = os.environ.get("CLUSTER_ROLE", "front")       # front | worker
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", 0))
+WORKER_PORT_BASE = int(os.environ.get("WORKER_PORT_BASE", 8100))
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 30))
+
+SHARDED_KEYS = ("active_groups", "group_configs")  # isi bot_data yang dibagi per grup
+
+LEASE = None  # ShardLease proses worker ini; None di mode satu proses
+
+def shard_of(chat_id, workers=None):
+    return chat_id % (workers or CLUSTER_WORKERS)
+
+def shard_bot_data(data, shard, workers=None):
+    """Salin bot_data mode satu proses, hanya menyisakan grup milik `shard` di SHARDED_KEYS."""
+    out = dict(data)
+    for key in SHARDED_KEYS:
+        value = data.get(key)
+        if isinstance(value, dict):
+            out[key] = {cid: v for cid, v in value.items() if shard_of(cid, workers) == shard}
+        elif isinstance(value, set):
+            out[key] = {cid for cid in value if shard_of(cid, workers) == shard}
+    return out
+
+def update_chat_id(data):
+    """chat_id dari update mentah, untuk routing ke shard; None jika tidak ada chat."""
+    for key in _MESSAGE_KEYS + _CHAT_KEYS:
+        m = data.get(key)
+        if m is not None:
+            return m.get("chat", {}).get("id")
+    cq = data.get("callback_query")
+    if cq is not None:
+        return (cq.get("message") or {}).get("chat", {}).get("id")
+    return None
+
+class ShardLease:
+    """Lease kepemilikan shard di tabel ``leases`` pada store bersama.
+
+    Hanya pemegang lease yang menerima update dan menjalankan job shard tsb.
+    Lease diperbarui tiap TTL/3; bila worker mati, worker pengganti baru bisa
+    mengambil alih setelah lease lama kedaluwarsa. Secara lokal lease dianggap
+    habis sepertiga TTL lebih awal supaya dua proses tidak pernah sama-sama
+    merasa memegang shard.
+    """
+
+    def __init__(self, filepath, shard, ttl=LEASE_TTL, owner=None):
+        self.shard = shard
+        self.ttl = ttl
+        self.owner = owner or PROCESS_OWNER
+        self.valid_until = 0.0
+        self._db = sqlite3.connect(filepath, isolation_level=None)
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def holds(self):
+        return time.time() < self.valid_until
+
+    def try_acquire(self):
+        now = time.time()
+        try:
+            cur = self._db.execute(
+                "INSERT INTO leases (shard, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (shard) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (self.shard, self.owner, now + self.ttl, now),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Gagal memperbarui lease shard {self.shard}: {e}")
+            return self.holds()
+        if cur.rowcount == 1:
+            self.valid_until = now + self.ttl * 2 / 3
+            return True
+        self.valid_until = 0.0
+        return False
+
+    def release(self):
+        self.valid_until = 0.0
+        self._db.execute("UPDATE leases SET expires = 0 WHERE shard = ? AND owner = ?", (self.shard, self.owner))
+
+    async def acquire(self):
+        """Tunggu sampai lease didapat (mis. menunggu lease worker lama habis)."""
+        while not self.try_acquire():
+            logger.info(f"⏳ Shard {self.shard} masih dipegang worker lain, menunggu lease...")
+            await asyncio.sleep(self.ttl / 3)
+
+    async def keep(self):
+        """Perpanjang lease terus-menerus; kembali jika lease sudah diambil proses lain."""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self.try_acquire() and not self.holds():
                 return
 
-            current_shift, _ = get_shift_info(now)
-            if sec in SUBMENUS and jam in TIMES[current_shift]:
-                key = f"{sec}_{jam}"
-                skips = context.chat_data.setdefault("skips", set())
-                if key not in skips:
-                    skips.add(key)
-                    await msg.reply_text(f"✅ {sec} {jam} Diterima!")
-                    await send_schedule_to_chat(context.bot, chat_id, context.chat_data, current_shift, message_id=context.chat_data.get("schedule_msg_id"))
+async def handle_front(request):
+    """Webhook front end: teruskan update mentah ke worker pemilik shard chat-nya."""
+    if not webhook_authorized(request):
+        WEBHOOK_STATS["unauthorized"] += 1
+        return web.Response(status=403)
+    body = await request.read()
+    try:
+        chat_id = update_chat_id(json.loads(body))
+    except ValueError:
+        return web.Response(status=400)
+    if chat_id is None:
+        WEBHOOK_STATS["filtered"] += 1
+        return web.Response()
+
+    url = request.app['workers'][shard_of(chat_id)]
+    try:
+        async with request.app['session'].post(url, data=body, headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET or "",
+        }) as resp:
+            # 503 dari worker (antrian penuh / lease belum dipegang) diteruskan
+            # apa adanya supaya Telegram mengirim ulang update tsb.
+            return web.Response(status=resp.status)
+    except ClientError as e:
+        logger.warning(f"Worker shard {shard_of(chat_id)} tidak bisa dihubungi: {e}")
+        return web.Response(status=503)
+
+async def supervise_worker(index):
+    """Jalankan satu proses worker dan hidupkan ulang jika berhenti."""
+    env = {**os.environ, "CLUSTER_ROLE": "worker", "WORKER_INDEX": str(index)}
+    while True:
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        try:
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            proc.terminate()
+            await proc.wait()
+            raise
+        logger.error(f"Worker {index} berhenti (kode {code}), dijalankan ulang.")
+        await asyncio.sleep(1)
+
+# ----------------------
+# Profil Startup
+# ----------------------
+class StartupProfile:
+    """Durasi tiap tahap boot, dilaporkan sebagai satu baris log (dan gauge di /metrics)."""
+
+    def __init__(self, started):
+        self.started = self.last = started
+        self.stages = []  # [(tahap, detik)]
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def report(self):
+        parts = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in self.stages)
+        logger.info(f"⏱️ Startup {self.last - self.started:.3f}s: {parts}")
+
+STARTUP = StartupProfile(BOOT_STARTED)
 
 # ----------------------
 # Main
 # ----------------------
 async def on_startup(app: Application):
+    load_group_configs(app.bot_data)
     active = app.bot_data.get("active_groups", set())
+    # Grup dengan konfigurasi jadwal sama berbagi satu Schedule, jadi cukup dipasang sekali.
+    for schedule in dict.fromkeys(group_config(cid).schedule for cid in active):
+        install_timeline(app.job_queue, schedule)
     for cid in active:
-        tid = app.chat_data.get(cid, {}).get("thread_id") or TARGET_THREAD_ID
-        schedule_group_jobs(app.job_queue, cid, tid)
-
-async def handle_root(request): return web.Response(text="Running")
-async def handle_webhook(request):
-    app = request.app['application']
-    await app.update_queue.put(Update.de_json(await request.json(), app.bot))
-    return web.Response()
+        register_group(cid)
+    if app.job_queue and not app.job_queue.get_jobs_by_name("recover"):
+        app.job_queue.run_repeating(job_recover, interval=RECOVERY_INTERVAL, first=RECOVERY_INTERVAL, name="recover")
 
-async def main():
-    persistence = PicklePersistence(filepath="bot_jadwal_data.pickle")
-    app = ApplicationBuilder().token(token).persistence(persistence).post_init(on_startup).build()
+def build_application(persistence=None, **builder_options):
+    """Rakit Application beserta semua handler. `builder_options` diteruskan ke ApplicationBuilder
+    (mis. base_url untuk server Bot API tiruan di benchmark)."""
+    builder = (ApplicationBuilder().token(token)
+               .persistence(persistence or SQLiteStatePersistence())
+               .update_queue(UpdateQueue(WEBHOOK_QUEUE_SIZE))
+               .concurrent_updates(ChatLaneUpdateProcessor()))
+    if METRICS.enabled:
+        builder = builder.request(InstrumentedRequest())
+    for name, value in builder_options.items():
+        builder = getattr(builder, name)(value)
+    app = builder.build()
 
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("aktifkan", aktifkan_cmd))
-    app.add_handler(CommandHandler("nonaktifkan", nonaktifkan_cmd))
-    app.add_handler(CommandHandler("status", status_cmd))
-    app.add_handler(CommandHandler("jadwal", jadwal_cmd))
-    app.add_handler(CommandHandler("rekap", rekap_cmd))
-    app.add_handler(CommandHandler("say", say_cmd))
+    app.add_handler(CommandHandler("start", instrumented(start_cmd)))
+    app.add_handler(CommandHandler("aktifkan", instrumented(aktifkan_cmd)))
+    app.add_handler(CommandHandler("nonaktifkan", instrumented(nonaktifkan_cmd)))
+    app.add_handler(CommandHandler("status", instrumented(status_cmd)))
+    app.add_handler(CommandHandler("jadwal", instrumented(jadwal_cmd)))
+    app.add_handler(CommandHandler("rekap", instrumented(rekap_cmd)))
+    app.add_handler(CommandHandler("statistik", instrumented(statistik_cmd)))
+    app.add_handler(CommandHandler("say", instrumented(say_cmd)))
+    app.add_handler(CommandHandler("atur", instrumented(atur_cmd)))
 
-    app.add_handler(CallbackQueryHandler(button))
-    app.add_handler(MessageHandler((filters.TEXT | filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND, auto_check_message))
+    app.add_handler(CallbackQueryHandler(instrumented(button)))
+    app.add_handler(ChatMemberHandler(instrumented(chat_member_update), ChatMemberHandler.ANY_CHAT_MEMBER))
+    app.add_handler(MessageHandler((filters.TEXT | filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND, instrumented(auto_check_message)))
+    return app
 
+def build_web_app():
+    """Web server dibuat sebelum Application supaya health check sudah menjawab selama
+    Application dirakit; webhook dijawab 503 sampai ``ready`` di-set oleh serve."""
     web_app = web.Application()
-    web_app['application'] = app
+    web_app['ready'] = asyncio.Event()
+    web_app['updates'] = asyncio.Queue(WEBHOOK_QUEUE_SIZE)
     web_app.add_routes([web.get('/', handle_root), web.post(WEBHOOK_PATH, handle_webhook)])
+    if METRICS.enabled:
+        web_app.add_routes([web.get('/metrics', handle_metrics)])
+    return web_app
 
-    if WEBHOOK_URL: await app.bot.set_webhook(WEBHOOK_URL)
-    runner = web.AppRunner(web_app)
+async def start_web(web_app, host, port):
+    runner = web.AppRunner(web_app, access_log=None)
     await runner.setup()
-    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    await web.TCPSite(runner, host, port).start()
+    STARTUP.mark("web")
+    return runner
 
-    await app.initialize()
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 20))
+
+def stop_signal():
+    """Event yang di-set saat SIGTERM/SIGINT diterima."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def serve(app, web_app, runner):
+    """Jalankan Application setelah web server siap, lalu putar ulang event yang terlewat."""
+    if METRICS.enabled:
+        register_metric_collectors(app)
+    await app.initialize()  # getMe + bot_data/user_data dari SQLite
+    STARTUP.mark("state")
+    # post_init hanya dipanggil run_polling/run_webhook, jadi jalankan manual.
+    await on_startup(app)
+    STARTUP.mark("jobs")
     await app.start()
-    while True: await asyncio.sleep(3600)
+    web_app['ingest'] = asyncio.create_task(webhook_ingest(app, web_app['updates']))
+    web_app['recovery'] = asyncio.create_task(catch_up(app))
+    web_app['ready'].set()
+    STARTUP.mark("start")
+    STARTUP.report()
+
+async def shutdown(app, web_app, runner):
+    """Berhenti tertib: tolak webhook baru, habiskan antrian update, kirim render dan pesan tertunda, flush state."""
+    logger.info("🛑 Shutdown: menghabiskan antrian...")
+    await runner.cleanup()
+    try:
+        await asyncio.wait_for(web_app['updates'].join(), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Sebagian update webhook belum diproses saat shutdown.")
+    web_app['ingest'].cancel()
+    web_app['recovery'].cancel()
+    await app.stop()  # sisa update_queue tetap diproses, JobQueue berhenti
+    await flush_schedule_renders(SHUTDOWN_TIMEOUT)
+    left = await OUTBOX.drain(SHUTDOWN_TIMEOUT)
+    if left:
+        logger.warning(f"{left} pesan di antrian kirim tidak sempat terkirim.")
+    await app.update_persistence()
+    await app.shutdown()  # flush SQLite + checkpoint WAL
+    logger.info("👋 Shutdown selesai.")
+
+async def main():
+    STARTUP.mark("import")
+    stop = stop_signal()
+    web_app = build_web_app()
+    runner = await start_web(web_app, '0.0.0.0', PORT)
+
+    persistence = SQLiteStatePersistence()
+    app = build_application(persistence)
+    if not persistence.has_data() and os.path.exists(PICKLE_FILE):
+        await persistence.import_pickle(app.bot)
+    STARTUP.mark("build")
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        STARTUP.mark("webhook")
+
+    await serve(app, web_app, runner)
+    await stop.wait()
+    await shutdown(app, web_app, runner)
+
+async def front_main():
+    """Front end mode cluster: pasang webhook, jalankan worker, routing update per shard."""
+    STARTUP.mark("import")
+    stop = stop_signal()
+    web_app = web.Application()
+    web_app['session'] = ClientSession()
+    web_app['workers'] = [f"http://127.0.0.1:{WORKER_PORT_BASE + i}{WEBHOOK_PATH}" for i in range(CLUSTER_WORKERS)]
+    web_app.add_routes([web.get('/', handle_root), web.post(WEBHOOK_PATH, handle_front)])
+    runner = await start_web(web_app, '0.0.0.0', PORT)
+
+    # Import pickle lama dilakukan di sini, sebelum worker pertama membuka STATE_DB.
+    persistence = SQLiteStatePersistence()
+    bot_app = ApplicationBuilder().token(token).build()
+    if not persistence.has_data() and os.path.exists(PICKLE_FILE):
+        await persistence.import_pickle(bot_app.bot)
+    supervisors = [asyncio.create_task(supervise_worker(i)) for i in range(CLUSTER_WORKERS)]
+    STARTUP.mark("build")
+
+    if WEBHOOK_URL:
+        async with bot_app.bot:
+            await bot_app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        STARTUP.mark("webhook")
+    STARTUP.report()
+    logger.info(f"🧭 Front end aktif, {CLUSTER_WORKERS} worker.")
+    await stop.wait()
+    await runner.cleanup()
+    # Membatalkan supervisor mengirim SIGTERM ke worker, yang lalu shutdown tertib sendiri.
+    for task in supervisors:
+        task.cancel()
+    await asyncio.gather(*supervisors, return_exceptions=True)
+    await web_app['session'].close()
+
+async def worker_main():
+    """Worker mode cluster: pegang lease shard WORKER_INDEX lalu layani grup shard tsb."""
+    global LEASE, OUTBOX
+    STARTUP.mark("import")
+    stop = stop_signal()
+    # Batas kirim global Telegram berlaku per token, jadi dibagi rata antar worker.
+    OUTBOX = Outbox(global_rate=OUTBOX_GLOBAL_RATE / CLUSTER_WORKERS)
+    LEASE = ShardLease(STATE_DB, WORKER_INDEX)
+    await LEASE.acquire()
+    STARTUP.mark("lease")
+
+    web_app = build_web_app()
+    runner = await start_web(web_app, '127.0.0.1', WORKER_PORT_BASE + WORKER_INDEX)
+    persistence = SQLiteStatePersistence(shard=WORKER_INDEX)
+    app = build_application(persistence)
+    STARTUP.mark("build")
+
+    await serve(app, web_app, runner)
+    logger.info(f"🧩 Worker shard {WORKER_INDEX}/{CLUSTER_WORKERS} aktif ({LEASE.owner}).")
+    keep = asyncio.create_task(LEASE.keep())
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait({keep, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    if keep.done():
+        logger.error(f"Lease shard {WORKER_INDEX} diambil alih proses lain, worker berhenti.")
+    keep.cancel()
+    stopping.cancel()
+    await shutdown(app, web_app, runner)
+    LEASE.release()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if not CLUSTER_WORKERS:
+        asyncio.run(main())
+    elif CLUSTER_ROLE == "worker":
+        asyncio.run(worker_main())
+    else:
+        asyncio.run(front_main())
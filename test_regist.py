@@ -0,0 +1,112 @@
+"""Uji klaim event terjadwal dan lease shard pada file SQLite sementara.
+
+Jalankan dengan ``python -m pytest -q``.
+"""
+import asyncio
+import datetime
+import types
+
+import pytest
+
+import regist
+
+EVENT = "start:pagi:08:00"
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def store(db, owner):
+    persistence = regist.SQLiteStatePersistence(filepath=db)
+    persistence.owner = owner
+    return persistence
+
+
+def lease(db, owner, shard=0):
+    return regist.ShardLease(db, shard, ttl=30, owner=owner)
+
+
+def status(persistence, chat_id=1, day=1, event=EVENT):
+    return persistence._db.execute(
+        "SELECT owner, status FROM fired_events WHERE chat_id = ? AND day = ? AND event = ?",
+        (chat_id, day, event),
+    ).fetchone()
+
+
+def test_double_claim(db):
+    a, b = store(db, "a"), store(db, "b")
+    assert lease(db, "a").try_acquire()
+    assert a.claim_event(1, 1, EVENT, 1.0)
+    # Pemilik yang sama maupun proses lain dengan lease hidup tidak boleh mengklaim ulang.
+    assert not a.claim_event(1, 1, EVENT, 1.0)
+    assert not b.claim_event(1, 1, EVENT, 1.0)
+    a.finish_event(1, 1, EVENT, "done")
+    assert not b.claim_event(1, 1, EVENT, 1.0)
+    assert status(a) == ("a", "done")
+
+
+def test_takeover_of_dead_owner(db):
+    dead, b = store(db, "dead"), store(db, "b")
+    assert dead.claim_event(1, 1, EVENT, 1.0)
+    # "dead" tidak memegang lease apa pun: klaimnya tertinggal dan boleh diambil alih.
+    assert b.stale_events(0) == [(1, 1, EVENT, 1.0)]
+    assert lease(db, "b").try_acquire()
+    assert b.claim_event(1, 1, EVENT, 1.0)
+    assert status(b) == ("b", "claimed")
+    # Pengambil alih memegang lease hidup, jadi klaimnya tidak bisa direbut balik.
+    assert not dead.claim_event(1, 1, EVENT, 1.0)
+
+
+def test_no_takeover_while_owner_holds_lease(db):
+    a, b = store(db, "a"), store(db, "b")
+    assert lease(db, "a").try_acquire()
+    assert a.claim_event(1, 1, EVENT, 1.0)
+    assert b.stale_events(0) == []
+    assert not b.claim_event(1, 1, EVENT, 1.0)
+
+
+def test_failed_event_is_retried_once(db, monkeypatch):
+    persistence = store(db, "me")
+    now = regist.now_local()
+    scheduled = now - datetime.timedelta(seconds=30)
+    day = regist.get_shift_info(scheduled)[1].toordinal()
+    sent = []
+
+    async def flaky(context, d):
+        sent.append(d["chat_id"])
+        if len(sent) == 1:
+            raise RuntimeError("timeout")
+
+    async def load_chat_data(app, chat_id):
+        return {}
+
+    monkeypatch.setitem(regist.TIMELINE_HANDLERS, "start", flaky)
+    monkeypatch.setattr(regist, "load_chat_data", load_chat_data)
+    monkeypatch.setattr(regist, "LEASE", None)
+    monkeypatch.setitem(regist._group_events, 1, ("pagi", ()))
+    context = types.SimpleNamespace(application=types.SimpleNamespace(persistence=persistence), bot=None)
+
+    async def run():
+        failed = await regist.fire_group_events(context, 1, (("start", "pagi", "08:00"),), scheduled)
+        assert failed == ["start"]
+        assert status(persistence, day=day) == ("me", "failed")
+        await regist.recover_events(context)
+        await regist.recover_events(context)
+
+    asyncio.run(run())
+    assert sent == [1, 1]
+    assert status(persistence, day=day) == ("me", "done")
+
+
+def test_only_one_lease_owner(db):
+    a, b = lease(db, "a"), lease(db, "b")
+    assert a.try_acquire() and a.holds()
+    assert not b.try_acquire() and not b.holds()
+    # Perpanjangan oleh pemilik yang sama tetap berhasil.
+    assert a.try_acquire()
+    a.release()
+    assert not a.holds()
+    assert b.try_acquire() and b.holds()
+    assert not a.try_acquire()